@@ -1,65 +1,147 @@
-import asyncio, traceback, json, os
+import asyncio, traceback, json, os, time, datetime, random
 
-from aiohttp import ClientSession, ClientError, ClientTimeout
+from aiohttp import ClientError
 from urllib.parse import quote
 
+import metrics
+import network
+from db.utils import get_file_hashes, save_file_hashes
 from static import config, logger
-from .utils import parse_macro
+from static.utils import TTLCache, get_template
 
 async def __request(**kwargs):
-    async with ClientSession(timeout=ClientTimeout(total=None)) as session:
+    async with network.use_session(kwargs['url']) as session:
+        time_start = time.monotonic()
         async with session.request(**kwargs) as res:
-            response = await res.json()
+            metrics.observe_api('alist', kwargs['url'], time_start)
+            # 被限流，交给上层按Retry-After等待
+            if res.status == 429:
+                return {'code': 429, 'message': "Too Many Requests", 'retry_after': get_retry_after(res)}
+            try:
+                response = await res.json(content_type=None)
+            except ValueError:
+                response = None
+            if not isinstance(response, dict):
+                raise AssertionError(f"HTTP {res.status}: {(await res.text())[:200]}")
+            # token失效，交给上层重新登录
+            if response.get('code') == 401:
+                return response
             # 如果alist报错找不到文件，返回码改成200
             if "object not found" in response.get('message', ''):
                 response.update({'code': 200})
                 return response
             # 其他情况只要OK就可以返回
-            assert res.ok
+            assert res.ok, f"HTTP {res.status}: {response}"
             return response
 
-async def request(filename="", max_retries=0, **kwargs):
-    '发送请求'
+def get_retry_after(res):
+    '读取Retry-After(只支持秒数)'
+    try:
+        return float(res.headers.get('Retry-After', 0))
+    except ValueError:
+        return 0
+
+def get_retry_delay(attempt:int, retry_after:float=0):
+    '第attempt次重试前等待的秒数'
+    settings = config.app
+    delay = min(settings['retry_interval'] * settings['retry_backoff']**(attempt-1), settings['retry_max_interval'])
+    if settings['retry_jitter'] > 0:
+        delay *= 1 + random.uniform(-1, 1) * settings['retry_jitter']
+    return max(delay, retry_after)
+
+async def request(filename="", max_retries=0, settings_alist:dict|None=None, hasher=None, counter=None, **kwargs):
+    '''
+    发送请求，上传文件时可以传入hasher顺便计算哈希
+    counter: 上传文件时每发送一块数据就调用一次(参数是字节数)
+    全部失败时返回的message是最后一次的错误
+    '''
     if max_retries <= 0:
         max_retries = config.app.get('max_retries', 6)
 
     # 自动重试
+    is_refreshed = False
+    retry_now = False
+    retry_after = 0
+    reason = ""
+    error = ""
+    server = metrics.get_server(kwargs['url'])
     for i in range(max_retries):
-        sleep_sec = min(4**(i-1), 600)
-        logger.info(f"({i+1}/{max_retries}) Requesting after {sleep_sec} seconds: {kwargs['url']}")
+        # 第一次和刚刷新过token的话直接请求
+        if i == 0 or retry_now:
+            sleep_sec = 0
+        else:
+            metrics.alist_retries.inc(server=server, reason=reason)
+            sleep_sec = get_retry_delay(i, retry_after)
+        retry_now = False
+        retry_after = 0
+        logger.info(f"({i+1}/{max_retries}) Requesting after {sleep_sec:.2f} seconds: {kwargs['url']}")
         await asyncio.sleep(sleep_sec)
         try:
+            if settings_alist:
+                await network.get_api_limiter(settings_alist).consume()
             if filename:
-                if os.path.getsize(filename) == 0:
+                file_size = os.path.getsize(filename)
+                if file_size == 0:
                     logger.warning(f"Skipping empty file {filename}..")
                     return {'code': 200, 'data': None}
                 else:
                     logger.debug(f"Loading file {filename}")
-                    with open(filename, "rb") as f:
-                        response = await __request(data=f, **kwargs)
+                    limiters = network.get_upload_limiters(settings_alist) if settings_alist else []
+                    data = network.read_file(
+                        filename, config.network['chunk_size'] * 1024, limiters,
+                        get_counter(kwargs['url'], counter), hasher,
+                        read_ahead=config.network['read_ahead']
+                        )
+                    headers = {**kwargs['headers'], 'Content-Length': str(file_size)}
+                    response = await __request(data=data, **{**kwargs, 'headers': headers})
             else:
                 response = await __request(**kwargs)
-        except AssertionError:
-            logger.warning(f"Response Error: {response}, retrying...")
+        except AssertionError as e:
+            reason = "response"
+            error = f"Response error: {e}"
+            logger.warning(f"Response Error: {e}, retrying...")
         except ClientError as e:
+            reason = "client"
+            error = f"Request error: {e!r}"
             logger.warning(f"Request Error, retrying: {e}")
         except TimeoutError:
+            reason = "timeout"
+            error = "Request timed out"
             logger.warning("Request time out, retrying...")
-        except Exception:
+        except Exception as e:
+            reason = "unknown"
+            error = f"Unknown error: {e!r}"
             logger.warning(f"Unknown Error, retrying: {traceback.format_exc()}")
         else:
             # return json.loads(response)
             # logger.debug(response)
             if response.get("code", 200) == 200:
                 return response
+            elif response.get("code") == 401 and settings_alist and is_refreshed is False:
+                # token失效，刷新一次
+                logger.warning("Token expired, logging in again...")
+                stale_token = kwargs['headers'].get('Authorization', '')
+                token = await token_cache.get(settings_alist, stale_token=stale_token)
+                kwargs['headers'] = {**kwargs['headers'], 'Authorization': token}
+                is_refreshed = True
+                retry_now = True
+                metrics.alist_retries.inc(server=server, reason="token")
+            elif response.get("code") == 429:
+                reason = "throttled"
+                error = f"Throttled by server: {response}"
+                retry_after = response['retry_after']
+                logger.warning(f"Throttled by server, retrying after at least {retry_after} seconds...")
             else:
+                reason = "response"
+                error = f"Response error: {response}"
                 logger.warning(f"Response Error, retrying: {response}")
     else:
+        metrics.alist_failures.inc(server=server)
         logger.error("All requests failed.")
-        return {'code': 500, 'data': None}
+        return {'code': 500, 'message': f"All {max_retries} requests failed, last error: {error}", 'data': None}
 
-async def get_alist_token(settings_alist:dict):
-    '获取alist管理token'
+async def login_alist(settings_alist:dict):
+    '登录alist获取新token'
     url = f"{settings_alist['url_alist']}/api/auth/login/hash"
     params = {
         "username": settings_alist['username'],
@@ -82,6 +164,50 @@ async def get_alist_token(settings_alist:dict):
     else:
         return ""
 
+class TokenCache:
+    '按(alist地址, 用户名)缓存的token'
+    __tokens: dict
+    __pending: dict
+
+    def __init__(self):
+        self.__tokens = {}
+        self.__pending = {}
+
+    @staticmethod
+    def get_key(settings_alist:dict):
+        '缓存键'
+        return (settings_alist['url_alist'], settings_alist['username'])
+
+    async def get(self, settings_alist:dict, stale_token=""):
+        '获取token，过期或者和stale_token相同时重新登录'
+        key = self.get_key(settings_alist)
+        token, expire_time = self.__tokens.get(key, ("", 0))
+        if token and token != stale_token and time.monotonic() < expire_time:
+            return token
+
+        # 同时请求的话共用一次登录
+        task = self.__pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.__login(key, settings_alist))
+            self.__pending[key] = task
+            task.add_done_callback(lambda _: self.__pending.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def __login(self, key, settings_alist:dict):
+        '登录并写入缓存'
+        token = await login_alist(settings_alist)
+        if token:
+            self.__tokens[key] = (token, time.monotonic() + config.network['token_ttl'])
+        else:
+            self.__tokens.pop(key, None)
+        return token
+
+token_cache = TokenCache()
+
+async def get_alist_token(settings_alist:dict):
+    '获取alist管理token(优先使用缓存)'
+    return await token_cache.get(settings_alist)
+
 async def get_alist(settings_alist:dict, token:str, path:str):
     '获取文件信息'
     url = f"{settings_alist['url_alist']}/api/fs/get"
@@ -96,6 +222,7 @@ async def get_alist(settings_alist:dict, token:str, path:str):
     # 获取请求结果
     res = await request(
         # max_retries=1,
+        settings_alist=settings_alist,
         method="post", 
         url=url, 
         data=json.dumps(data), 
@@ -108,6 +235,127 @@ async def get_alist(settings_alist:dict, token:str, path:str):
         logger.error(f"Unknown error when getting path {path}")
         return {}
 
+async def list_alist(settings_alist:dict, token:str, path:str, refresh=False):
+    '分页获取文件夹内容，返回{文件名: (大小, 修改时间, 哈希)}，文件夹不存在时返回空字典，出错时返回None；refresh让alist跳过自己的缓存'
+    url = f"{settings_alist['url_alist']}/api/fs/list"
+    headers = {
+        "Authorization": token,
+        "Content-Type": "application/json"
+    }
+    per_page = config.network['list_page_size']
+
+    remote_files = {}
+    page = 1
+    while True:
+        data = {
+            "path": path,
+            "page": page,
+            "per_page": per_page,
+            "refresh": refresh and page == 1,
+        }
+        res = await request(
+            settings_alist=settings_alist,
+            method="post", 
+            url=url, 
+            data=json.dumps(data), 
+            headers=headers
+            )
+        if res['code'] != 200:
+            logger.error(f"Unknown error when listing path {path}")
+            return None
+        if not res['data']:
+            # 文件夹不存在
+            return remote_files
+
+        content = res['data']['content'] or []
+        for item in content:
+            remote_files[item['name']] = (item['size'], item['modified'], item.get('hash_info') or {})
+        if not content or page * per_page >= res['data']['total']:
+            return remote_files
+        page += 1
+
+# (alist地址, 远程文件夹) -> 文件列表
+list_cache: TTLCache|None = None
+
+def get_list_cache():
+    '获取远程文件列表缓存，第一次用到时才按配置创建'
+    global list_cache
+    if list_cache is None:
+        list_cache = TTLCache(ttl=config.network['list_cache_ttl'], maxsize=config.network['list_cache_size'])
+    return list_cache
+
+def apply_settings():
+    '把当前配置应用到远程文件列表缓存上'
+    if list_cache is None:
+        return
+    list_cache.ttl = config.network['list_cache_ttl']
+    list_cache.maxsize = config.network['list_cache_size']
+
+async def get_remote_files(settings_alist:dict, token:str, path:str, use_cache=True):
+    '获取文件夹内容，优先使用缓存；不使用缓存时alist那边也会刷新'
+    key = (settings_alist['url_alist'], path.rstrip('/'))
+    if use_cache:
+        remote_files = get_list_cache().get(key)
+        if remote_files is not None:
+            return remote_files
+    remote_files = await list_alist(settings_alist, token, path, refresh=not use_cache)
+    if remote_files is not None:
+        get_list_cache().set(key, remote_files)
+    return remote_files
+
+def update_remote_files(settings_alist:dict, dest_filename:str, size:int|None=None, hashes:dict={}):
+    '上传成功后直接更新缓存，不用再查询一遍；size为None时表示文件已删除'
+    dirname, name = os.path.split(dest_filename)
+    remote_files = get_list_cache().get((settings_alist['url_alist'], dirname.rstrip('/')))
+    if remote_files is None:
+        return
+    if size is None:
+        remote_files.pop(name, None)
+    else:
+        remote_files[name] = (size, datetime.datetime.now().astimezone().isoformat(), hashes)
+
+async def is_remote_same(settings_alist:dict, token:str, filename:str, dest_filename:str, remote_files:dict|None):
+    '''
+    根据文件夹列表判断远程文件是否和本地一致，列表获取失败时单独查询
+    大小必须一致；本地哈希已缓存并且alist也提供了同类哈希时，哈希也要一致
+    '''
+    if remote_files is None:
+        data = await get_alist(settings_alist, token, path=dest_filename)
+        remote = (data['size'], data.get('modified', ''), data.get('hash_info') or {}) if data else None
+    else:
+        remote = remote_files.get(os.path.split(dest_filename)[1])
+    if remote is None:
+        return False
+
+    remote_size, _, remote_hashes = remote
+    local_size = os.path.getsize(filename)
+    if remote_size != local_size:
+        logger.warning(f"Remote file {dest_filename} size mismatch ({remote_size}/{local_size})")
+        return False
+    if remote_hashes:
+        local_hashes = await get_file_hashes(filename)
+        for hash_type, value in remote_hashes.items():
+            if value and hash_type in local_hashes and value.lower() != local_hashes[hash_type]:
+                logger.warning(f"Remote file {dest_filename} {hash_type} mismatch")
+                return False
+    return True
+
+async def get_hasher(filename:str):
+    '本地文件的哈希还没缓存时，返回上传时顺便计算哈希的对象，已缓存的文件不再计算'
+    hash_types = config.network['hash_types']
+    if not hash_types or await get_file_hashes(filename):
+        return None
+    stat = os.stat(filename)
+    return network.StreamHasher(hash_types, stat.st_size, stat.st_mtime)
+
+async def save_hasher(filename:str, hasher):
+    '文件完整读完的话缓存计算出来的哈希，返回哈希'
+    if hasher is None or not hasher.is_complete:
+        return {}
+    hashes = hasher.hexdigest()
+    await save_file_hashes(filename, hasher.file_size, hasher.mtime, hashes)
+    return hashes
+
 async def copy_alist(settings_alist:dict, token:str, source_dir:str, filenames:list, dist_dir:str):
     '复制文件'
     # 请求参数
@@ -124,12 +372,15 @@ async def copy_alist(settings_alist:dict, token:str, source_dir:str, filenames:l
 
     # 请求API
     data = await request(
+        settings_alist=settings_alist,
         method="post",
         url=url, 
         data=json.dumps(data), 
         headers=headers
         )
 
+    get_list_cache().pop((settings_alist['url_alist'], dist_dir.rstrip('/')))
+
     # 获取结果
     if data['code'] == 200:
         logger.info("Copy success.")
@@ -153,12 +404,15 @@ async def rm_alist(settings_alist:dict, token:str, dirname:str, filenames:list):
 
     # 请求API
     data = await request(
+        settings_alist=settings_alist,
         method="post",
         url=url, 
         data=json.dumps(data), 
         headers=headers
         )
 
+    get_list_cache().pop((settings_alist['url_alist'], dirname.rstrip('/')))
+
     # 获取结果
     if data['code'] == 200:
         logger.info("Remove success:", dirname, filenames)
@@ -167,22 +421,32 @@ async def rm_alist(settings_alist:dict, token:str, dirname:str, filenames:list):
     
     return data['code']
 
-async def upload_alist(settings_alist:dict, token:str, filename:str, dest_filename:str):
-    '流式上传文件'
-    dest_filename = quote(dest_filename) # URL编码
-
-    # 请求参数
-    url = f"{settings_alist['url_alist']}/api/fs/put"
-    headers = {
+def get_upload_headers(token:str, dest_filename:str):
+    '上传请求头'
+    return {
         "Authorization": token,
-        "File-Path": dest_filename,
+        "File-Path": quote(dest_filename), # URL编码
         "As-Task": "True",
         "Content-Type": "application/octet-stream",
     }
 
+async def upload_alist(settings_alist:dict, token:str, filename:str, dest_filename:str, is_removable=True, counter=None):
+    '''
+    流式上传文件，返回错误信息，成功时为空字符串
+    counter: 每发送一块数据就调用一次(参数是字节数)
+    '''
+    # 请求参数
+    url = f"{settings_alist['url_alist']}/api/fs/put"
+    headers = get_upload_headers(token, dest_filename)
+
     # 打开文件
+    hasher = await get_hasher(filename)
+    time_start = time.monotonic()
     response_json = await request(
         filename=filename, 
+        settings_alist=settings_alist,
+        hasher=hasher,
+        counter=counter,
         method="put", 
         url=url, 
         headers=headers
@@ -191,28 +455,234 @@ async def upload_alist(settings_alist:dict, token:str, filename:str, dest_filena
 
     if response_json['code'] == 200:
         logger.info(f"Upload success: {filename}")
+        file_size = os.path.getsize(filename)
+        metrics.observe_upload(settings_alist['url_alist'], file_size, time_start)
+        hashes = await save_hasher(filename, hasher)
+        update_remote_files(settings_alist, dest_filename, file_size, hashes)
         # 是否在上传后删除文件
-        if settings_alist['remove_after_upload']:
-            os.remove(filename)
-        return True
+        if is_removable and settings_alist['remove_after_upload']:
+            removal_queue.add(filename, [(settings_alist, token, dest_filename)])
+        return ""
     else:
         logger.error("{} Upload failed: {}".format(filename, response_json))
+        return response_json.get('message') or str(response_json)
+
+def get_counter(url:str, counter=None):
+    '发送字节数的统计回调，另外传了counter的话一起调用'
+    sent_counter = metrics.get_sent_counter(url)
+    if counter is None:
+        return sent_counter
+    def count(size:int):
+        sent_counter(size)
+        counter(size)
+    return count
+
+async def __read_queue(queue:asyncio.Queue, limiters:list, counter):
+    '从队列里取出数据块发送'
+    while (chunk := await queue.get()) is not None:
+        for limiter in limiters:
+            await limiter.consume(len(chunk))
+        counter(len(chunk))
+        yield chunk
+
+async def __put_chunk(queue:asyncio.Queue, chunk, request_task:asyncio.Task):
+    '把数据块放进队列，对应的请求已经结束的话返回False'
+    if request_task.done():
+        return False
+    put_task = asyncio.ensure_future(queue.put(chunk))
+    await asyncio.wait([put_task, request_task], return_when=asyncio.FIRST_COMPLETED)
+    if not put_task.done():
+        put_task.cancel()
         return False
+    return True
+
+async def __upload_stream(settings_alist:dict, token:str, dest_filename:str, file_size:int, queue:asyncio.Queue, counter=None):
+    '上传一个从队列读取的数据流，只尝试一次，返回错误信息，成功时为空字符串'
+    url = f"{settings_alist['url_alist']}/api/fs/put"
+    headers = get_upload_headers(token, dest_filename)
+    headers['Content-Length'] = str(file_size)
+    data = __read_queue(
+        queue, network.get_upload_limiters(settings_alist), get_counter(settings_alist['url_alist'], counter)
+        )
+    try:
+        await network.get_api_limiter(settings_alist).consume()
+        response = await __request(method="put", url=url, headers=headers, data=data)
+    except Exception as e:
+        logger.warning(f"Fan-out upload to {dest_filename} error: {traceback.format_exc()}")
+        return f"Fan-out upload error: {e!r}"
+    if response.get('code', 200) != 200:
+        logger.warning(f"Fan-out upload to {dest_filename} error: {response}")
+        return f"Fan-out upload error: {response}"
+    return ""
+
+async def upload_alist_fanout(targets:list, filename:str, counters:list|None=None):
+    '''
+    只读取一次文件，同时上传到多个目标，返回每个目标的错误信息(成功时为空字符串)
+    targets: [(settings_alist, token, dest_filename), ...]
+    counters: 每个目标发送数据时调用的回调(参数是字节数)，可以不传
+    '''
+    counters = counters or [None] * len(targets)
+    is_removable = any(settings_alist['remove_after_upload'] for settings_alist, _, _ in targets)
+    file_size = os.path.getsize(filename)
+    if len(targets) <= 1 or file_size == 0:
+        results = [
+            await upload_alist(settings_alist, token, filename, dest_filename, is_removable=False, counter=counter)
+            for (settings_alist, token, dest_filename), counter in zip(targets, counters)
+            ]
+    else:
+        # 每个目标一个有界队列，最慢的目标会让读取停下来等它
+        queues = [asyncio.Queue(maxsize=config.network['fanout_buffer']) for _ in targets]
+        request_tasks = [
+            asyncio.create_task(__upload_stream(settings_alist, token, dest_filename, file_size, queue, counter))
+            for (settings_alist, token, dest_filename), queue, counter in zip(targets, queues, counters)
+            ]
+        is_alive = [True] * len(targets)
+        try:
+            hasher = await get_hasher(filename)
+            time_start = time.monotonic()
+            async for chunk in network.read_file(
+                filename, config.network['chunk_size'] * 1024, hasher=hasher, read_ahead=config.network['read_ahead']
+                ):
+                is_alive = await asyncio.gather(*[
+                    __put_chunk(queue, chunk, task) if alive else asyncio.sleep(0, False)
+                    for queue, task, alive in zip(queues, request_tasks, is_alive)
+                    ])
+                if not any(is_alive):
+                    break
+            for queue, task, alive in zip(queues, request_tasks, is_alive):
+                if alive:
+                    await __put_chunk(queue, None, task)
+            results = list(await asyncio.gather(*request_tasks))
+        finally:
+            # 读文件出错或者被取消的话，还在等数据的请求要停掉，不然连接一直占着
+            unfinished = [task for task in request_tasks if not task.done()]
+            for task in unfinished:
+                task.cancel()
+            await asyncio.gather(*unfinished, return_exceptions=True)
+        hashes = await save_hasher(filename, hasher) if "" in results else {}
+
+        # 失败的目标单独重新上传(带重试)
+        for idx, (settings_alist, token, dest_filename) in enumerate(targets):
+            if not results[idx]:
+                logger.info(f"Upload success: {filename} -> {settings_alist['url_alist']}")
+                metrics.observe_upload(settings_alist['url_alist'], file_size, time_start)
+                update_remote_files(settings_alist, dest_filename, file_size, hashes)
+            else:
+                results[idx] = await upload_alist(
+                    settings_alist, token, filename, dest_filename, is_removable=False, counter=counters[idx]
+                    )
+
+    # 所有目标都成功以后再删除
+    if is_removable and not any(results):
+        removal_queue.add(filename, targets)
+    return results
+
+
+class RemovalQueue:
+    '''
+    上传后删除本地文件前先确认远程文件完整(As-Task上传时alist返回成功后可能还在往存储里传)
+    定期成批检查: 每个远程文件夹只列一次，确认过的本地文件一起删除
+    '''
+    __pending: dict
+    __task: asyncio.Task|None
+
+    def __init__(self):
+        # 本地文件名 -> {'targets': [(settings_alist, token, dest_filename)], 'attempts': 检查次数}
+        self.__pending = {}
+        self.__task = None
+
+    def add(self, filename:str, targets:list):
+        '加入待删除的文件，所有目标都确认以后才删除'
+        item = self.__pending.setdefault(filename, {'targets': [], 'attempts': 0})
+        item['targets'].extend(targets)
+        if self.__task is None or self.__task.done():
+            self.__task = asyncio.create_task(self.__run())
+
+    def __len__(self):
+        return len(self.__pending)
+
+    async def wait(self):
+        '等待所有待删除的文件处理完'
+        if self.__task is not None:
+            await self.__task
+
+    async def close(self):
+        '停止检查，还没确认的文件不删除'
+        if self.__task is None:
+            return
+        self.__task.cancel()
+        await asyncio.gather(self.__task, return_exceptions=True)
+        self.__task = None
+        if self.__pending:
+            logger.warning(f"{len(self.__pending)} uploaded files are kept because they were not verified yet")
+            self.__pending.clear()
+
+    async def __run(self):
+        '有待删除的文件时定期检查'
+        while self.__pending:
+            await asyncio.sleep(config.network['verify_interval'])
+            try:
+                await self.verify()
+            except Exception:
+                logger.error(f"Failed to verify uploaded files: {traceback.format_exc()}")
+
+    async def verify(self):
+        '检查一轮，返回删除的文件'
+        items = list(self.__pending.items())
+
+        # 每个(alist, 远程文件夹)只列一次，跳过alist的缓存
+        remote_files_dict = {}
+        for _, item in items:
+            for settings_alist, token, dest_filename in item['targets']:
+                key = (settings_alist['url_alist'], os.path.split(dest_filename)[0])
+                if key not in remote_files_dict:
+                    remote_files_dict[key] = await get_remote_files(settings_alist, token, key[1], use_cache=False)
+
+        removed = []
+        for filename, item in items:
+            if not os.path.exists(filename):
+                del self.__pending[filename]
+                continue
+            for settings_alist, token, dest_filename in item['targets']:
+                key = (settings_alist['url_alist'], os.path.split(dest_filename)[0])
+                if not await is_remote_same(settings_alist, token, filename, dest_filename, remote_files_dict[key]):
+                    break
+            else:
+                removed.append(filename)
+                del self.__pending[filename]
+                continue
+            item['attempts'] += 1
+            if item['attempts'] >= config.network['verify_attempts']:
+                logger.error(f"Uploaded file could not be verified, keeping {filename}")
+                del self.__pending[filename]
+
+        # 确认过的文件一起删除
+        for filename in removed:
+            os.remove(filename)
+        if removed:
+            logger.info(f"Removed {len(removed)} verified local files: {removed}")
+        return removed
+
+removal_queue = RemovalQueue()
 
 
 ### Frequently Used Methods
 async def upload_video(video_filename:str, settings_alist:dict={}, rec_info:dict={}):
-    '上传视频'
+    '上传视频，返回是否全部上传成功'
     # 判断一下有没有开启自动上传功能
     if not settings_alist['enabled']:
-        return
+        return True
 
     # 获取token
     token = await get_alist_token(settings_alist)
 
     # 文件名处理
     appendices = ['flv', 'jsonl', 'xml', 'jpg', 'mp4'] # 可能存在的后缀名
+    remote_files_dict = {} # 远程文件夹 -> 文件列表
     filenames = []
+    # 同一段录播的所有文件放在同一个文件夹，只填充一次模板
+    if rec_info:
+        dist_dir = get_template(settings_alist['remote_dir']).render(rec_info)
     for appendix in appendices:
         # 本地文件名
         local_filename = "{}.{}".format(os.path.splitext(video_filename)[0], appendix)
@@ -221,14 +691,11 @@ async def upload_video(video_filename:str, settings_alist:dict={}, rec_info:dict
 
         # 远程文件名
         if rec_info:
-            dist_dir = parse_macro(settings_alist['remote_dir'], rec_info)
             dest_filename = os.path.join(dist_dir, os.path.split(local_filename)[1])
             # 检测文件是否已在远程目录存在
-            if await get_alist(
-                token=token, 
-                path=dest_filename, 
-                settings_alist=settings_alist
-                ) is not None:
+            if dist_dir not in remote_files_dict:
+                remote_files_dict[dist_dir] = await get_remote_files(settings_alist, token, dist_dir)
+            if await is_remote_same(settings_alist, token, local_filename, dest_filename, remote_files_dict[dist_dir]):
                 logger.warning(f"Remote file {dest_filename} exists, skipping...")
                 continue
         else:
@@ -239,13 +706,11 @@ async def upload_video(video_filename:str, settings_alist:dict={}, rec_info:dict
     
 
     # 上传文件
-    loop = asyncio.get_event_loop()
     tasks = []
     for i in filenames:
         local_filename = i[0]
         dest_filename = i[1]
         tasks.append(upload_alist(settings_alist, token, local_filename, dest_filename))
-    wait_coro = asyncio.wait(tasks)
-    loop.run_until_complete(wait_coro)
-    loop.close()
+    errors = await asyncio.gather(*tasks)
+    return not any(errors)
 
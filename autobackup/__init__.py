@@ -4,21 +4,38 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from loguru import logger
 
 from static import config
+from db.models import BackupTask
+from db.utils import sync_servers
 
-from .utils import change_status, upload, add_task, scheduled_check
+from . import utils
+from .utils import change_status, upload, add_task, scheduled_check, reschedule
 
 
 async def init():
     '初始化'
-    interval = config.autobackup['check_interval']
+    # 上次退出时没传完的任务重新排队
+    await BackupTask.filter(status='uploading').update(status='waiting')
+    await sync_servers(config.autobackup)
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(scheduled_check, trigger="interval", seconds=interval)
     scheduler.start()
-    logger.debug(f"Autobackup scheduler started (Interval: {interval}s)")
+    # 只在最早的任务到点时唤醒
+    utils.scheduler = scheduler
+    await reschedule()
+    logger.debug("Autobackup scheduler started")
     return scheduler
 
-async def add_autobackup(settings_autobackup:dict, local_dir:str, now=False):
-    '自动备份功能'
+async def close():
+    '取消正在进行的上传，这些任务下次启动时重新排队'
+    tasks = list(utils.running_uploads)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+async def add_autobackup(settings_autobackup:dict, local_dir:str, now=False, time_ref:datetime.datetime|None=None):
+    '''
+    自动备份功能
+    time_ref: 按这个时间决定放今天还是第二天，默认是现在
+    '''
     for settings_alist in settings_autobackup['servers']:
         # 判断一下开没开
         if not settings_alist['enabled']:
@@ -27,7 +44,7 @@ async def add_autobackup(settings_autobackup:dict, local_dir:str, now=False):
         try:
             # 读取时间
             scheduled_time = settings_alist['time']
-            datetime_now = datetime.datetime.now().astimezone()
+            datetime_now = (time_ref or datetime.datetime.now()).astimezone()
             time_today = datetime_now.strftime(r'%H:%M:%S')
 
             # 如果立即上传的话
@@ -1,58 +1,158 @@
-import os, json, traceback, datetime
+import os, json, traceback, datetime, asyncio
 
 import alist
+import metrics
+import network
+from tortoise.exceptions import IntegrityError
+from tortoise.functions import Count
+
 from static import logger, config
-from db.models import BackupTask
+from db.models import BackupTask, BackupFile
+from db.utils import get_server_id
+
+# 正在运行的上传协程
+running_uploads = set()
+# 限制并发数的信号量: 名称 -> (上限, 信号量)
+semaphores = {}
+# 定时器，由init()设置
+scheduler = None
+WAKEUP_JOB_ID = "autobackup_wakeup"
+# 查询下一个任务出错时，隔多久(秒)再检查
+WAKEUP_RETRY_DELAY = 60
+# 同一时间只有一次检查在取任务
+check_lock = asyncio.Lock()
+# 已经不需要再上传的文件状态
+FINISHED_FILE_STATUS = ('completed', 'skipped')
 
 async def add_task(t, local_dir, settings_alist):
     '添加任务'
     task_dict = {
         'time': t,
         'local_dir': local_dir,
-        'settings_alist': settings_alist,
+        'server_id': await get_server_id(settings_alist),
         'status': 'waiting',
     }
     logger.debug(f"Adding task scheduled at {t.isoformat()}")
 
-    # 查重
-    if await BackupTask.filter(
-        local_dir=local_dir, settings_alist=settings_alist, time=t
-        ).count() == 0:
-        # 上传时间、配置、本地文件夹均不相同时才新建
+    # 查重: 上传时间、配置、本地文件夹均不相同时才新建(数据库唯一约束)
+    try:
         await BackupTask.create(**task_dict)
-        logger.debug("Task created.")
-    else:
+    except IntegrityError:
         logger.debug("Task not created as existing")
+    else:
+        logger.debug("Task created.")
+        await reschedule()
 
 async def upload(task_dict):
     '执行上传'
-    # 分离参数
-    local_dir = task_dict['local_dir']
-    settings_temp = task_dict['settings_alist']
-    dest_dir = get_dest_dir(local_dir, settings_temp['remote_dir'])
-    
+    results = await upload_fanout([task_dict])
+    return results[task_dict['id']]
+
+async def get_pending_files(task_id:int, local_dir:str, filenames:list):
+    '获取任务还没传完的文件，新出现的文件会先记录下来，返回{文件名: BackupFile}'
+    file_list = await BackupFile.filter(task_id=task_id)
+    recorded_filenames = {backup_file.filename for backup_file in file_list}
+    new_files = [
+        BackupFile(
+            task_id=task_id,
+            filename=filename,
+            size=os.path.getsize(os.path.join(local_dir, filename)),
+            status='waiting'
+            )
+        for filename in filenames if filename not in recorded_filenames
+        ]
+    if new_files:
+        await BackupFile.bulk_create(new_files)
+        file_list = await BackupFile.filter(task_id=task_id)
+    return {
+        backup_file.filename: backup_file for backup_file in file_list
+        if backup_file.status not in FINISHED_FILE_STATUS and backup_file.filename in filenames
+        }
+
+async def upload_fanout(task_dict_list:list):
+    '''
+    执行上传，同一本地文件夹的多个任务只读取一次文件，返回{任务id: 是否全部成功}
+    重试时只上传之前没有成功的文件
+    '''
     # 获取文件名，去除文件夹
-    filenames = os.listdir(local_dir)
-    for idx, filename in enumerate(filenames):
-        if os.path.isdir(os.path.join(local_dir, filename)):
-            del filenames[idx]
-    
-    # 获取token
-    token = await alist.get_alist_token(settings_temp)
+    local_dir = task_dict_list[0]['local_dir']
+    filenames = [
+        filename for filename in os.listdir(local_dir)
+        if not os.path.isdir(os.path.join(local_dir, filename))
+        ]
+
+    # 获取还没完成的文件，有的话再获取token和远程文件夹列表
+    pending_files_dict = {}
+    tokens = {}
+    remote_files_dict = {}
+    for task_dict in task_dict_list:
+        task_id = task_dict['id']
+        pending_files_dict[task_id] = await get_pending_files(task_id, local_dir, filenames)
+        if not pending_files_dict[task_id]:
+            continue
+        settings_temp = task_dict['settings_alist']
+        token = await alist.get_alist_token(settings_temp)
+        dest_dir = get_dest_dir(local_dir, settings_temp['remote_dir'])
+        tokens[task_id] = token
+        remote_files_dict[task_id] = await alist.get_remote_files(settings_temp, token, dest_dir)
 
     # 上传文件
-    all_ok = True
-    for filename in filenames:
+    all_ok = {task_dict['id']: True for task_dict in task_dict_list}
+    file_semaphore = asyncio.Semaphore(config.autobackup['max_files'])
+
+    async def upload_file(filename):
+        '上传单个文件到所有需要的目标'
         local_filename = os.path.join(local_dir, filename)
-        dest_filename = os.path.join(dest_dir, filename)
-        ## 检查文件是否已存在
-        if await alist.get_alist(settings_temp, token, path=dest_filename):
-            logger.warning(f"File {dest_filename} exists, skipping...")
-            continue
-        ## 上传
-        is_ok = await alist.upload_alist(settings_temp, token, local_filename, dest_filename)
-        if not is_ok:
-            all_ok = False
+        targets = []
+        target_files = []
+        for task_dict in task_dict_list:
+            backup_file = pending_files_dict[task_dict['id']].get(filename)
+            if backup_file is None:
+                continue
+            settings_temp = task_dict['settings_alist']
+            token = tokens[task_dict['id']]
+            dest_dir = get_dest_dir(local_dir, settings_temp['remote_dir'])
+            dest_filename = os.path.join(dest_dir, filename)
+            ## 检查文件是否已存在
+            remote_files = remote_files_dict[task_dict['id']]
+            if await alist.is_remote_same(settings_temp, token, local_filename, dest_filename, remote_files):
+                logger.warning(f"File {dest_filename} exists, skipping...")
+                await BackupFile.filter(id=backup_file.id).update(status='skipped')
+                continue
+            targets.append((settings_temp, token, dest_filename))
+            target_files.append((task_dict['id'], backup_file))
+        if not targets:
+            return
+
+        ## 上传，每个目标分别统计这次发送的字节数(包括重试)
+        bytes_sent = [0] * len(targets)
+        def get_counter(idx):
+            def count(size:int):
+                bytes_sent[idx] += size
+            return count
+        async with file_semaphore:
+            for _, backup_file in target_files:
+                await BackupFile.filter(id=backup_file.id).update(
+                    status='uploading', attempts=backup_file.attempts+1
+                    )
+            errors = await alist.upload_alist_fanout(
+                targets, local_filename, counters=[get_counter(idx) for idx in range(len(targets))]
+                )
+        for (task_id, backup_file), error, sent in zip(target_files, errors, bytes_sent):
+            if not error:
+                await BackupFile.filter(id=backup_file.id).update(
+                    status='completed', bytes_sent=sent, last_error=""
+                    )
+            else:
+                all_ok[task_id] = False
+                await BackupFile.filter(id=backup_file.id).update(
+                    status='failed', bytes_sent=sent, last_error=error
+                    )
+
+    pending_filenames = set()
+    for pending_files in pending_files_dict.values():
+        pending_filenames.update(pending_files.keys())
+    await asyncio.gather(*[upload_file(filename) for filename in pending_filenames])
 
     # 返回状态
     return all_ok
@@ -64,7 +164,7 @@ async def del_task(id:int, del_all=False):
         await BackupTask.all().delete()
     else:
         await BackupTask.filter(id=id).delete()
-    return await show_status()
+    return await count_status()
 
 async def retry_task(id:int, retry_all=False):
     '重试任务'
@@ -77,38 +177,62 @@ async def retry_task(id:int, retry_all=False):
     # 开工
     for i in id_dict_list:
         await change_status(i['id'], 'waiting')
+    await reschedule()
 
-    return await show_status()
+    return await count_status()
 
 
 async def change_status(id:int, status:str):
     '改变任务状态'
     await BackupTask.filter(id=id).update(status=status)
     # backup_job_list[id]['status'] = status
-    return await show_status()
-
-
-async def show_status():
-    '获取备份情况'
-    res_str = ''
-    backup_job_list = await BackupTask.all().values('status', 'id', 'time', 'local_dir', 'settings_alist')
-    for idx, i in enumerate(backup_job_list):
-        config_temp = i['settings_alist']
-        res_str += "ID: {} \tStatus: {} \tScheduled Time: {} \tLocal dir:{} \tRemote dir:{} \n".format(
-            i['id'],
-            i['status'],
-            i['time'].isoformat(),
-            i['local_dir'],
-            f"{config_temp['url_alist']}{config_temp['remote_dir']}"
+
+
+async def count_status(server_id:int=0):
+    '按状态统计任务数量'
+    query = BackupTask.all()
+    if server_id:
+        query = query.filter(server_id=server_id)
+    res = await query.annotate(count=Count('id')).group_by('status').values('status', 'count')
+    return {i['status']: i['count'] for i in res}
+
+
+async def get_status(status:str="", server_id:int=0, cursor:int=0, limit:int=50):
+    '''
+    分页获取备份情况
+    status: 只看指定状态的任务
+    server_id: 只看指定服务器的任务
+    cursor: 从这个任务ID之后开始(上一页返回的next_cursor)
+    '''
+    query = BackupTask.filter(id__gt=cursor)
+    if status:
+        query = query.filter(status=status)
+    if server_id:
+        query = query.filter(server_id=server_id)
+    # 多取一个，用来判断还有没有下一页
+    task_list = await query.order_by('id').limit(limit + 1).values(
+        'status', 'id', 'time', 'local_dir', 'server_id',
+        url_alist='server__url_alist', remote_dir='server__remote_dir'
         )
-    return res_str
+    next_cursor = task_list[limit-1]['id'] if len(task_list) > limit else None
+    task_list = task_list[:limit]
+    for task_dict in task_list:
+        task_dict['time'] = task_dict['time'].isoformat()
+
+    return {
+        'tasks': task_list,
+        'next_cursor': next_cursor,
+        'counts': await count_status(server_id),
+        }
 
 
 async def dump_task(filename:str):
     '导出任务'
     # 处理时间问题
     task_list = []
-    backup_job_list = await BackupTask.all().values('status', 'time', 'local_dir', 'settings_alist')
+    backup_job_list = await BackupTask.all().values(
+        'status', 'time', 'local_dir', settings_alist='server__settings_alist'
+        )
     for idx, task in enumerate(backup_job_list):
         task_dict = task.copy()
         task_dict.update({
@@ -143,39 +267,112 @@ async def load_task(filename:str):
     # 处理时间问题
     for idx, task in enumerate(task_list):
         timestamp = task['time']
-        task_list[idx]['time'] = datetime.datetime.fromtimestamp(timestamp)
+        task_list[idx]['time'] = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc)
+        task_list[idx]['server_id'] = await get_server_id(task_list[idx].pop('settings_alist'))
     # backup_job_list.extend(task_list)
 
-    # 同步到数据库
-    await BackupTask.bulk_create([BackupTask(**i) for i in task_list])
+    # 同步到数据库，已存在的任务跳过
+    await BackupTask.bulk_create([BackupTask(**i) for i in task_list], ignore_conflicts=True)
+    await reschedule()
 
 
 async def scheduled_check():
-    '定时检查是不是该备份了'
-    logger.debug("Start checking autobackups...")
-    backup_job_list = await BackupTask.filter(status='waiting').values(
-        'status', 'id', 'time', 'local_dir', 'settings_alist'
+    '定时检查是不是该备份了，到点的任务放到后台并发执行'
+    async with check_lock:
+        try:
+            logger.debug("Start checking autobackups...")
+            # 只取到点的任务，剩下的由reschedule()立即再唤醒一次
+            datetime_now = datetime.datetime.now(tz=datetime.timezone.utc)
+            due_task_list = await BackupTask.filter(
+                status='waiting', time__lte=datetime_now
+                ).order_by('time').limit(config.autobackup['batch_size']).values(
+                'status', 'id', 'time', 'local_dir', settings_alist='server__settings_alist'
+                )
+
+            # 开启fanout的话，同一文件夹的任务一起上传
+            task_groups = {}
+            for task_dict in due_task_list:
+                key = task_dict['local_dir'] if config.autobackup['fanout'] else task_dict['id']
+                task_groups.setdefault(key, []).append(task_dict)
+
+            for task_dict_list in task_groups.values():
+                # 发现到点了并且待上传
+                for task_dict in task_dict_list:
+                    await change_status(task_dict['id'], 'uploading')
+                upload_task = asyncio.create_task(run_tasks(task_dict_list))
+                running_uploads.add(upload_task)
+                upload_task.add_done_callback(running_uploads.discard)
+        finally:
+            # 出错也要排好下一次检查，唤醒只有一次性的定时任务
+            await reschedule()
+
+async def reschedule():
+    '按最早的待上传任务设定下一次检查时间，没有任务的话就不检查'
+    if scheduler is None:
+        return
+    try:
+        task_dict = await BackupTask.filter(status='waiting').order_by('time').first().values('time')
+    except Exception:
+        # 数据库出错的话过一会儿再检查一次，不能让唤醒就此断掉
+        logger.error(f"Failed to get next autobackup task: {traceback.format_exc()}")
+        run_date = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(seconds=WAKEUP_RETRY_DELAY)
+        __add_wakeup(run_date)
+        return
+    if not task_dict:
+        if scheduler.get_job(WAKEUP_JOB_ID):
+            scheduler.remove_job(WAKEUP_JOB_ID)
+        logger.debug("No waiting autobackup task.")
+        return
+    run_date = max(task_dict['time'], datetime.datetime.now(tz=datetime.timezone.utc))
+    __add_wakeup(run_date)
+
+def __add_wakeup(run_date:datetime.datetime):
+    '设定下一次检查时间'
+    # 检查过程中也会调用这里，允许再排一次检查等在锁上，不然到点的唤醒会被跳过，任务就一直等着
+    scheduler.add_job(
+        scheduled_check, trigger="date", run_date=run_date,
+        id=WAKEUP_JOB_ID, replace_existing=True, misfire_grace_time=None, max_instances=2
         )
-    for _, task_dict in enumerate(backup_job_list):
-        if datetime.datetime.now(tz=datetime.timezone.utc) >= task_dict['time']:# and task_dict['status'] == 'waiting':
-            # 发现到点了并且待上传
-            task_id = task_dict['id']
+    logger.debug(f"Next autobackup check at {run_date.isoformat()}")
+
+async def run_tasks(task_dict_list:list):
+    '执行一组任务，每个备份服务器(同一alist下的不同存储分开算)一条通道，慢的服务器不会挡住别的服务器'
+    # 按固定顺序获取信号量，避免fanout任务之间互相等待
+    lanes = sorted({
+        network.get_server_key(task_dict['settings_alist'])
+        for task_dict in task_dict_list
+        })
+    lane_semaphores = [
+        get_semaphore(f"server:{lane}", config.autobackup['max_tasks_per_server'])
+        for lane in lanes
+        ]
+    for semaphore in lane_semaphores:
+        await semaphore.acquire()
+    try:
+        async with get_semaphore("tasks", config.autobackup['max_tasks']):
+            # 拿到信号量才算真正开始，排队等待的时间也算在延迟里
+            datetime_start = datetime.datetime.now(tz=datetime.timezone.utc)
+            for task_dict in task_dict_list:
+                metrics.scheduler_lag.observe(max(0, (datetime_start - task_dict['time']).total_seconds()))
             logger.info(f"Auto backuping...")
-            logger.debug(f"{task_dict}")
-            await change_status(task_id, 'uploading')
+            logger.debug(f"{task_dict_list}")
             # 上传
             try:
-                all_ok = await upload(task_dict)
+                all_ok = await upload_fanout(task_dict_list)
             except Exception as e:
                 logger.error(traceback.format_exc())
-                await change_status(task_id, 'failed')
+                for task_dict in task_dict_list:
+                    await change_status(task_dict['id'], 'failed')
             else:
                 # 标记为已完成
-                if all_ok:
-                    await change_status(task_id, 'completed')
-                else:
-                    await change_status(task_id, 'partically failed')
-            # break
+                for task_id, is_ok in all_ok.items():
+                    if is_ok:
+                        await change_status(task_id, 'completed')
+                    else:
+                        await change_status(task_id, 'partically failed')
+    finally:
+        for semaphore in lane_semaphores:
+            semaphore.release()
 
     # 自动删除完成的任务
     if config.autobackup['auto_remove']:
@@ -183,6 +380,14 @@ async def scheduled_check():
 
 
 ### Utils
+def get_semaphore(name:str, limit:int):
+    '获取并发限制信号量，上限改了的话之后的任务用新的'
+    item = semaphores.get(name)
+    if item is None or item[0] != limit:
+        item = (limit, asyncio.Semaphore(limit))
+        semaphores[name] = item
+    return item[1]
+
 def get_dest_dir(local_dir: str, remote_dir: str):
     '自动拼接本地文件夹和设置里的远程文件夹名，获取远程文件夹名称'
     last_dir = os.path.split(local_dir)[1]
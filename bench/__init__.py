@@ -0,0 +1,547 @@
+import asyncio, datetime, json, os, random, sys, time, platform, subprocess, uuid
+
+import toml, uvicorn
+
+import alist
+import autobackup
+import db
+import metrics
+import network
+from autobackup.utils import add_task
+from db.models import BackupTask, UploadJob
+from static import config, logger
+
+from .utils import StubAlist, StubBlrec, FaultInjector, LoopLagMonitor, make_file, make_real_file, drop_cache, get_time, get_stats
+
+MiB = 1024 * 1024
+
+
+def setup_config(url_alist:str, url_blrec:str, urls_backup:list=[], db_url:str="sqlite://:memory:"):
+    '把运行中的配置指向假服务器(只改内存里的，不写回文件)'
+    config.db['url'] = db_url
+    config.blrec['url_blrec'] = url_blrec
+    config.alist.update(
+        enabled=True,
+        url_alist=url_alist,
+        username="bench",
+        password="bench",
+        remote_dir="/bench/{room_info/room_id}",
+        remove_after_upload=False,
+        upload_limit=0,
+        api_rate=0,
+        )
+    config.autobackup['auto_remove'] = True
+    config.autobackup['servers'] = [
+        {
+            'enabled': True,
+            'time': "00:00:00",
+            'url_alist': url,
+            'username': "bench",
+            'password': "bench",
+            'remote_dir': "/backup",
+            'remove_after_upload': False,
+            'upload_limit': 0,
+            'api_rate': 0,
+        }
+        for url in urls_backup
+        ]
+
+async def wait_until(condition, timeout:float, interval:float=0.05):
+    '等待条件成立，超时返回False'
+    time_end = time.monotonic() + timeout
+    while time.monotonic() < time_end:
+        if await condition():
+            return True
+        await asyncio.sleep(interval)
+    return False
+
+
+async def bench_webhook(workdir:str, db_url:str, events:int=20, size:int=64, rooms:int=4, interval:float=0, timeout:float=600):
+    '''
+    webhook到上传完成的端到端延迟
+    events: 发送的VideoPostprocessingCompletedEvent数量
+    size: 每个视频文件的大小(MiB)，另外每个事件带一个1KiB的弹幕文件
+    interval: 发送事件的间隔(秒)，0表示一次性全部发送
+    '''
+    import server
+
+    stub_alist = await StubAlist().start()
+    stub_blrec = await StubBlrec().start()
+    setup_config(stub_alist.url, stub_blrec.url, db_url=db_url)
+
+    # 生成录播文件
+    event_list = []
+    for idx in range(events):
+        room_id = 1000 + idx % rooms
+        path = os.path.join(workdir, "webhook", str(room_id), f"rec_{idx}.flv")
+        make_file(path, size * MiB)
+        make_file(os.path.splitext(path)[0] + ".xml", 1024)
+        remote_dir = f"/bench/{room_id}"
+        event_list.append({
+            'payload': {
+                'id': str(uuid.uuid4()),
+                'date': get_time().isoformat(),
+                'type': "VideoPostprocessingCompletedEvent",
+                'data': {'room_id': room_id, 'path': path},
+                },
+            'remote_files': [
+                f"{remote_dir}/rec_{idx}.flv",
+                f"{remote_dir}/rec_{idx}.xml",
+                ],
+            })
+
+    # 启动服务端
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=0, log_level="warning"))
+    serve_task = asyncio.create_task(uvicorn_server.serve())
+    while not uvicorn_server.started:
+        if serve_task.done():
+            # 启动失败，把异常抛出来
+            serve_task.result()
+            raise RuntimeError("Server exited before startup")
+        await asyncio.sleep(0.01)
+    port = uvicorn_server.servers[0].sockets[0].getsockname()[1]
+    url_webhook = f"http://127.0.0.1:{port}/blrec"
+
+    # 发送事件
+    response_times = []
+    time_start = time.monotonic()
+    session = network.get_session(url_webhook)
+
+    async def send(event:dict):
+        event['sent'] = time.monotonic()
+        async with session.post(url_webhook, json=event['payload']) as res:
+            assert res.ok, await res.text()
+        response_times.append(time.monotonic() - event['sent'])
+
+    sending = []
+    for event in event_list:
+        sending.append(asyncio.create_task(send(event)))
+        if interval > 0:
+            await asyncio.sleep(interval)
+    await asyncio.gather(*sending)
+
+    # 等待上传完成
+    async def is_finished():
+        return all(path in stub_alist.uploaded for event in event_list for path in event['remote_files'])
+    await wait_until(is_finished, timeout=timeout)
+    elapsed = time.monotonic() - time_start
+
+    latencies = []
+    for event in event_list:
+        if all(path in stub_alist.uploaded for path in event['remote_files']):
+            latencies.append(max(stub_alist.uploaded[path] for path in event['remote_files']) - event['sent'])
+
+    uvicorn_server.should_exit = True
+    await serve_task
+    await stub_alist.close()
+    await stub_blrec.close()
+
+    return {
+        'params': {'events': events, 'size': size * MiB, 'rooms': rooms, 'interval': interval},
+        'elapsed': elapsed,
+        'completed': len(latencies),
+        'webhook_response': get_stats(response_times),
+        'latency': get_stats(latencies),
+        'throughput_bytes': stub_alist.bytes_received / elapsed,
+        'alist_requests': stub_alist.requests,
+        }
+
+
+async def bench_upload(workdir:str, db_url:str, size:int=2048, servers:int=1):
+    '''
+    单个大文件的上传吞吐量
+    size: 文件大小(MiB)
+    servers: 同时上传到几个服务器(大于1时使用fanout)
+    '''
+    stubs = [await StubAlist().start() for _ in range(servers)]
+    stub_blrec = await StubBlrec().start()
+    setup_config(stubs[0].url, stub_blrec.url, [stub.url for stub in stubs], db_url=db_url)
+
+    filename = os.path.join(workdir, "upload", "big.flv")
+    make_file(filename, size * MiB)
+
+    targets = []
+    for idx, settings_alist in enumerate(config.autobackup['servers']):
+        token = await alist.get_alist_token(settings_alist)
+        targets.append((settings_alist, token, f"/backup/upload/big_{idx}.flv"))
+
+    monitor = LoopLagMonitor().start()
+    time_start = time.monotonic()
+    if servers > 1:
+        results = await alist.upload_alist_fanout(targets, filename)
+    else:
+        settings_alist, token, dest_filename = targets[0]
+        results = [await alist.upload_alist(settings_alist, token, filename, dest_filename, is_removable=False)]
+    elapsed = time.monotonic() - time_start
+    loop_lag = await monitor.stop()
+
+    bytes_received = sum(stub.bytes_received for stub in stubs)
+    for stub in stubs:
+        await stub.close()
+    await stub_blrec.close()
+    await network.close()
+    os.remove(filename)
+
+    return {
+        'params': {'size': size * MiB, 'servers': servers},
+        'elapsed': elapsed,
+        'ok': not any(results),
+        'throughput_bytes': bytes_received / elapsed,
+        'read_throughput_bytes': size * MiB / elapsed,
+        'loop_lag': loop_lag,
+        }
+
+
+async def bench_readahead(workdir:str, db_url:str, size:int=512, read_ahead:list=[0, 4]):
+    '''
+    对比不同预读块数下上传时的事件循环延迟和吞吐量(0是直接在事件循环里读文件)
+    文件真正写入磁盘，每轮之前清出页缓存；假alist跑在单独的线程里
+    size: 文件大小(MiB)
+    read_ahead: 要对比的预读块数
+    '''
+    stub = StubAlist().start_in_thread()
+    stub_blrec = await StubBlrec().start()
+    setup_config(stub.url, stub_blrec.url, [stub.url], db_url=db_url)
+    read_ahead_orig = config.network['read_ahead']
+
+    filename = os.path.join(workdir, "readahead", "big.flv")
+    make_real_file(filename, size * MiB)
+    settings_alist = config.autobackup['servers'][0]
+    token = await alist.get_alist_token(settings_alist)
+
+    runs = []
+    try:
+        for idx, depth in enumerate(read_ahead):
+            drop_cache(filename)
+            config.network['read_ahead'] = depth
+            bytes_start = stub.bytes_received
+            monitor = LoopLagMonitor().start()
+            time_start = time.monotonic()
+            error = await alist.upload_alist(settings_alist, token, filename, f"/backup/readahead/big_{idx}.flv", is_removable=False)
+            elapsed = time.monotonic() - time_start
+            loop_lag = await monitor.stop()
+            runs.append({
+                'read_ahead': depth,
+                'elapsed': elapsed,
+                'ok': not error,
+                'throughput_bytes': (stub.bytes_received - bytes_start) / elapsed,
+                'loop_lag': loop_lag,
+                })
+    finally:
+        config.network['read_ahead'] = read_ahead_orig
+        stub.close_in_thread()
+        await stub_blrec.close()
+        await network.close()
+        os.remove(filename)
+
+    return {
+        'params': {'size': size * MiB, 'chunk_size': config.network['chunk_size'] * 1024, 'read_ahead': read_ahead},
+        'elapsed': sum(item['elapsed'] for item in runs),
+        'runs': runs,
+        }
+
+
+async def bench_scheduler(workdir:str, db_url:str, tasks:int=200, files:int=2, servers:int=2, timeout:float=600):
+    '''
+    自动备份调度的吞吐量
+    tasks: 任务数量，平均分给各个服务器
+    files: 每个任务的文件数(每个1KiB)
+    '''
+    stubs = [await StubAlist().start() for _ in range(servers)]
+    stub_blrec = await StubBlrec().start()
+    setup_config(stubs[0].url, stub_blrec.url, [stub.url for stub in stubs], db_url=db_url)
+
+    await db.init_db()
+    await network.init()
+    scheduler = await autobackup.init()
+
+    local_dirs = []
+    for idx in range(tasks):
+        local_dir = os.path.join(workdir, "scheduler", str(idx))
+        for file_idx in range(files):
+            make_file(os.path.join(local_dir, f"{file_idx}.xml"), 1024)
+        local_dirs.append(local_dir)
+
+    # 全部设为已到期
+    time_start = time.monotonic()
+    time_due = get_time()
+    for idx, local_dir in enumerate(local_dirs):
+        settings_alist = config.autobackup['servers'][idx % servers]
+        await add_task(time_due, local_dir, settings_alist)
+    add_elapsed = time.monotonic() - time_start
+
+    async def is_finished():
+        return await BackupTask.filter(status__in=['waiting', 'uploading']).count() == 0
+    await wait_until(is_finished, timeout=timeout)
+    elapsed = time.monotonic() - time_start
+    not_completed = await BackupTask.filter(status__not='completed').count()
+
+    scheduler.shutdown()
+    for stub in stubs:
+        await stub.close()
+    await stub_blrec.close()
+    await network.close()
+    await db.close()
+
+    return {
+        'params': {'tasks': tasks, 'files': files, 'servers': servers},
+        'add_elapsed': add_elapsed,
+        'elapsed': elapsed,
+        'tasks_per_second': tasks / elapsed,
+        'not_completed': not_completed,
+        'files_uploaded': sum(len(stub.uploaded) for stub in stubs),
+        }
+
+
+def get_retry_counts():
+    '按原因统计alist请求的重试次数'
+    retries = {}
+    for _, labels, value in metrics.alist_retries.collect():
+        retries[labels['reason']] = retries.get(labels['reason'], 0) + value
+    return retries
+
+async def bench_soak(workdir:str, db_url:str, rooms:int=6, segments:int=4, size:int=32, duration:float=60,
+                     faults:dict={}, seed:int=0, timeout:float=3600):
+    '''
+    故障注入下的长时间运行测试，模拟压缩后的一天录播
+    rooms/segments: 直播间数量和每个直播间的录播分段数，分段在duration秒内随机完成
+    size: 视频的平均大小(MiB)，实际在0.5~1.5倍之间
+    faults: FaultInjector的参数，同时作用于立即上传和自动备份的服务器
+    录播全部结束后自动备份开始，等到上传队列和自动备份都处理完(或失败)为止
+    '''
+    import server
+
+    rand = random.Random(seed)
+    stub_alist = await StubAlist(FaultInjector(**faults, seed=seed)).start()
+    stub_backup = await StubAlist(FaultInjector(**faults, seed=seed+1)).start()
+    stub_blrec = await StubBlrec().start()
+    setup_config(stub_alist.url, stub_blrec.url, [stub_backup.url], db_url=db_url)
+    # 录播结束后开始备份
+    time_backup = datetime.datetime.now() + datetime.timedelta(seconds=duration + 1)
+    config.autobackup['servers'][0]['time'] = time_backup.strftime(r'%H:%M:%S')
+
+    # 生成录播文件
+    event_list = []
+    local_sizes = {}
+    for room_idx in range(rooms):
+        room_id = 1000 + room_idx
+        for segment in range(segments):
+            path = os.path.join(workdir, "soak", str(room_id), f"rec_{segment}.flv")
+            file_size = int(size * MiB * rand.uniform(0.5, 1.5))
+            make_file(path, file_size)
+            make_file(os.path.splitext(path)[0] + ".xml", 1024)
+            local_sizes[f"/bench/{room_id}/rec_{segment}.flv"] = file_size
+            local_sizes[f"/bench/{room_id}/rec_{segment}.xml"] = 1024
+            local_sizes[f"/backup/{room_id}/rec_{segment}.flv"] = file_size
+            local_sizes[f"/backup/{room_id}/rec_{segment}.xml"] = 1024
+            event_list.append({
+                'offset': rand.uniform(0, duration),
+                'payload': {
+                    'id': str(uuid.uuid4()),
+                    'date': get_time().isoformat(),
+                    'type': "VideoPostprocessingCompletedEvent",
+                    'data': {'room_id': room_id, 'path': path},
+                    },
+                'remote_files': [
+                    f"/bench/{room_id}/rec_{segment}.flv",
+                    f"/bench/{room_id}/rec_{segment}.xml",
+                    ],
+                })
+    event_list.sort(key=lambda x: x['offset'])
+
+    # 启动服务端
+    uvicorn_server = uvicorn.Server(uvicorn.Config(server.app, host="127.0.0.1", port=0, log_level="warning"))
+    serve_task = asyncio.create_task(uvicorn_server.serve())
+    while not uvicorn_server.started:
+        if serve_task.done():
+            serve_task.result()
+            raise RuntimeError("Server exited before startup")
+        await asyncio.sleep(0.01)
+    port = uvicorn_server.servers[0].sockets[0].getsockname()[1]
+    url_webhook = f"http://127.0.0.1:{port}/blrec"
+    session = network.get_session(url_webhook)
+    retries_start = get_retry_counts()
+
+    # 按时间发送事件
+    time_start = time.monotonic()
+    for event in event_list:
+        await asyncio.sleep(max(0, time_start + event['offset'] - time.monotonic()))
+        event['sent'] = time.monotonic()
+        async with session.post(url_webhook, json=event['payload']) as res:
+            assert res.ok, await res.text()
+    time_last_event = time.monotonic()
+
+    # 等待上传队列和自动备份都处理完
+    async def is_finished():
+        if datetime.datetime.now() < time_backup:
+            return False
+        if await UploadJob.filter(status__in=['waiting', 'running']).exists():
+            return False
+        return not await BackupTask.filter(status__in=['waiting', 'uploading']).exists()
+    is_timeout = not await wait_until(is_finished, timeout=timeout, interval=0.2)
+    time_end = time.monotonic()
+
+    # 统计
+    latencies = []
+    for event in event_list:
+        if all(path in stub_alist.uploaded for path in event['remote_files']):
+            latencies.append(max(stub_alist.uploaded[path] for path in event['remote_files']) - event['sent'])
+    remote_files = {**stub_alist.files, **stub_backup.files}
+    bytes_received = stub_alist.bytes_received + stub_backup.bytes_received
+    bytes_stored = sum(remote_files.values())
+    put_requests = stub_alist.requests.get('fs_put', 0) + stub_backup.requests.get('fs_put', 0)
+    retries_end = get_retry_counts()
+    failed_jobs = await UploadJob.filter(status='failed').count()
+    failed_tasks = await BackupTask.filter(status__not='completed').count()
+
+    uvicorn_server.should_exit = True
+    await serve_task
+    await stub_alist.close()
+    await stub_backup.close()
+    await stub_blrec.close()
+
+    return {
+        'params': {
+            'rooms': rooms, 'segments': segments, 'size': size * MiB, 'duration': duration, 'seed': seed,
+            'faults': stub_alist.faults.get_params(),
+            'retry': {key: config.app[key] for key in ('max_retries', 'retry_interval', 'retry_backoff', 'retry_max_interval', 'retry_jitter')},
+            'queue': dict(config.queue),
+            },
+        'elapsed': time_end - time_start,
+        'timeout': is_timeout,
+        'time_to_completion': time_end - time_last_event,
+        'latency': get_stats(latencies),
+        'files': len(local_sizes),
+        'missing_files': len([path for path in local_sizes if path not in remote_files]),
+        'corrupted_files': len([path for path, size in local_sizes.items() if remote_files.get(path, size) != size]),
+        'failed_jobs': failed_jobs,
+        'failed_tasks': failed_tasks,
+        'bytes_expected': sum(local_sizes.values()),
+        'bytes_received': bytes_received,
+        'wasted_bytes': bytes_received - bytes_stored,
+        'put_requests': put_requests,
+        'retry_amplification': put_requests / len(local_sizes),
+        'retries': {reason: retries_end[reason] - retries_start.get(reason, 0) for reason in retries_end},
+        'faults_injected': {
+            name: stub_alist.faults.injected[name] + stub_backup.faults.injected[name]
+            for name in FaultInjector.FAULTS
+            },
+        }
+
+
+# 入口模块 -> 导入时不应该加载的重量级模块
+IMPORT_FORBIDDEN = {
+    'client': ['bilibili_api', 'tortoise', 'fastapi', 'apscheduler'],
+    'server': ['bilibili_api'],
+}
+
+def parse_importtime(output:str):
+    '解析python -X importtime的输出，返回[(模块名, 自身耗时, 累计耗时)]，单位秒'
+    res = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        if not self_us.strip().isdigit():
+            # 表头
+            continue
+        res.append((name.strip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return res
+
+async def bench_imports(workdir:str, db_url:str, budgets:dict={'client': 0.5, 'server': 2}, repeat:int=3):
+    '''
+    入口模块的导入耗时(每次都在新进程里导入，取最快的一次)，超出预算或者加载了不该加载的模块时ok为false
+    budgets: 模块名 -> 预算(秒)
+    '''
+    root = os.path.split(os.path.split(os.path.abspath(__file__))[0])[0]
+    env = {**os.environ, 'PYTHONPATH': root}
+    time_start = time.monotonic()
+    modules = {}
+    for module, budget in budgets.items():
+        best = None
+        for _ in range(repeat):
+            res = await asyncio.to_thread(
+                subprocess.run, [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                capture_output=True, text=True, env=env
+                )
+            if res.returncode != 0:
+                raise RuntimeError(f"Failed to import {module}: {res.stderr[-2000:]}")
+            timings = parse_importtime(res.stderr)
+            total = next(t[2] for t in timings if t[0] == module)
+            if best is None or total < best[0]:
+                best = (total, timings)
+        total, timings = best
+        names = {t[0] for t in timings}
+        unexpected = [name for name in IMPORT_FORBIDDEN.get(module, []) if name in names]
+        modules[module] = {
+            'seconds': total,
+            'budget': budget,
+            'ok': total <= budget and not unexpected,
+            'unexpected': unexpected,
+            'slowest': [
+                {'module': name, 'self': t_self, 'cumulative': t_cumulative}
+                for name, t_self, t_cumulative in sorted(timings, key=lambda t: t[1], reverse=True)[:5]
+                ],
+            }
+        if not modules[module]['ok']:
+            logger.error(f"Importing {module} took {total:.3f}s (budget {budget}s), unexpected modules: {unexpected}")
+
+    return {
+        'params': {'budgets': budgets, 'repeat': repeat},
+        'elapsed': time.monotonic() - time_start,
+        'ok': all(item['ok'] for item in modules.values()),
+        'modules': modules,
+        }
+
+
+benchmarks = {
+    'webhook': bench_webhook,
+    'upload': bench_upload,
+    'readahead': bench_readahead,
+    'scheduler': bench_scheduler,
+    'soak': bench_soak,
+    'imports': bench_imports,
+}
+# 不指定时运行的测试(soak耗时较长，需要单独指定)
+default_benchmarks = ['webhook', 'upload', 'scheduler', 'imports']
+
+def get_commit():
+    '当前代码的commit，不是git仓库时返回空'
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.split(os.path.abspath(__file__))[0]
+            ).stdout.strip()
+    except Exception:
+        return ""
+
+async def run(names:list, workdir:str, db_url:str, params:dict={}):
+    '依次运行指定的测试，params: 测试名 -> 参数'
+    results = {}
+    for name in names:
+        logger.info(f"Running benchmark {name}...")
+        results[name] = await benchmarks[name](workdir, db_url, **params.get(name, {}))
+        logger.info(f"Benchmark {name} finished in {results[name]['elapsed']:.2f}s")
+    return results
+
+def apply_overrides(overrides:list):
+    '临时修改配置，格式为section.key=value，value按toml解析(例如queue.retry_interval=5)'
+    sections = {'server': config.app}
+    for item in overrides:
+        name, value = item.split('=', 1)
+        section, key = name.split('.', 1)
+        settings = sections.get(section) or getattr(config, section)
+        settings[key] = toml.loads(f"value = {value}")['value']
+
+def write_results(results:dict, filename:str):
+    '把结果写成json'
+    data = {
+        'time': get_time().isoformat(),
+        'commit': get_commit(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'benchmarks': results,
+        }
+    with open(filename, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+    return data
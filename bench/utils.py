@@ -0,0 +1,317 @@
+import asyncio, os, time, datetime, random, threading
+
+from aiohttp import web
+from urllib.parse import unquote
+
+
+class StubServer:
+    '跑在本进程里的假服务器'
+    app: web.Application
+
+    def __init__(self):
+        self.app = web.Application(client_max_size=0)
+        self.__runner = None
+        self.port = 0
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self):
+        '启动，端口由系统分配'
+        self.__runner = web.AppRunner(self.app, access_log=None)
+        await self.__runner.setup()
+        site = web.TCPSite(self.__runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = self.__runner.addresses[0][1]
+        return self
+
+    async def close(self):
+        '关闭'
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+            self.__runner = None
+
+    def start_in_thread(self):
+        '在单独的线程和事件循环里启动，测事件循环延迟时不受假服务器干扰'
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = threading.Thread(target=self.__loop.run_forever, daemon=True)
+        self.__thread.start()
+        asyncio.run_coroutine_threadsafe(self.start(), self.__loop).result()
+        return self
+
+    def close_in_thread(self):
+        '关闭在单独线程里启动的服务器'
+        asyncio.run_coroutine_threadsafe(self.close(), self.__loop).result()
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
+        self.__loop.close()
+
+
+class FaultInjector:
+    '''
+    按概率给假服务器注入故障，各项概率之和不超过1
+    latency: 平均附加延迟(秒)，在0~2倍之间均匀分布
+    error_rate: 返回5xx
+    throttle_rate: 返回429和Retry-After
+    truncate_rate: 上传读到一半断开连接(只对上传有效)
+    reset_rate: 收到请求直接断开连接
+    '''
+    FAULTS = ('reset', 'throttle', 'error', 'truncate')
+
+    def __init__(self, latency:float=0, error_rate:float=0, throttle_rate:float=0,
+                 truncate_rate:float=0, reset_rate:float=0, retry_after:float=1, seed:int=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.truncate_rate = truncate_rate
+        self.reset_rate = reset_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.injected = {name: 0 for name in self.FAULTS}
+
+    def get_params(self):
+        '故障参数'
+        return {
+            'latency': self.latency,
+            'error_rate': self.error_rate,
+            'throttle_rate': self.throttle_rate,
+            'truncate_rate': self.truncate_rate,
+            'reset_rate': self.reset_rate,
+            'retry_after': self.retry_after,
+            }
+
+    def pick(self, is_upload=False):
+        '决定这次请求出什么故障，没有故障时返回空字符串'
+        x = self.random.random()
+        for name in self.FAULTS:
+            rate = getattr(self, f"{name}_rate")
+            if x < rate:
+                if name == 'truncate' and not is_upload:
+                    return ""
+                self.injected[name] += 1
+                return name
+            x -= rate
+        return ""
+
+    async def delay(self):
+        '附加延迟'
+        if self.latency > 0:
+            await asyncio.sleep(self.random.uniform(0, 2 * self.latency))
+
+
+class StubAlist(StubServer):
+    '假alist，文件只记录大小，不保存内容'
+    files: dict
+    uploaded: dict
+    bytes_received: int
+    requests: dict
+    faults: FaultInjector
+
+    def __init__(self, faults:FaultInjector|None=None):
+        super().__init__()
+        self.files = {}
+        self.uploaded = {}
+        self.bytes_received = 0
+        self.requests = {}
+        self.faults = faults or FaultInjector()
+        self.app.middlewares.append(self.inject_faults)
+        self.app.router.add_post('/api/auth/login/hash', self.login)
+        self.app.router.add_post('/api/fs/get', self.get)
+        self.app.router.add_post('/api/fs/list', self.list)
+        self.app.router.add_put('/api/fs/put', self.put)
+
+    def count(self, path:str):
+        '记录请求次数(包括被注入故障的请求)'
+        api = path.removeprefix('/api/').replace('/', '_')
+        self.requests[api] = self.requests.get(api, 0) + 1
+
+    @web.middleware
+    async def inject_faults(self, request:web.Request, handler):
+        '注入故障'
+        self.count(request.path)
+        await self.faults.delay()
+        fault = self.faults.pick(is_upload=request.method == "PUT")
+        if fault == 'reset':
+            # 直接断开
+            request.transport.close()
+            return web.Response(status=500)
+        elif fault == 'throttle':
+            return web.json_response(
+                {'code': 429, 'message': "Too Many Requests"},
+                status=429, headers={'Retry-After': str(self.faults.retry_after)}
+                )
+        elif fault == 'error':
+            return web.Response(status=self.faults.random.choice([500, 502, 503]), text="Injected server error")
+        elif fault == 'truncate':
+            # 读一部分数据后断开(断开以后的回复不会真的发出去)
+            limit = self.faults.random.randint(0, request.content_length or 0)
+            size = 0
+            async for chunk in request.content.iter_chunked(64 * 1024):
+                size += len(chunk)
+                if size >= limit:
+                    break
+            self.bytes_received += size
+            request.transport.close()
+            return web.Response(status=500)
+        return await handler(request)
+
+    async def login(self, request:web.Request):
+        return web.json_response({'code': 200, 'message': "success", 'data': {'token': "bench-token"}})
+
+    async def get(self, request:web.Request):
+        path = (await request.json())['path']
+        if path not in self.files:
+            return web.json_response({'code': 500, 'message': "failed get object: object not found", 'data': None})
+        data = {'name': os.path.split(path)[1], 'size': self.files[path], 'is_dir': False}
+        return web.json_response({'code': 200, 'message': "success", 'data': data})
+
+    async def list(self, request:web.Request):
+        body = await request.json()
+        path = body['path'].rstrip('/')
+        page, per_page = body.get('page', 1), body.get('per_page', 0)
+        content = [
+            {'name': os.path.split(name)[1], 'size': size, 'modified': "", 'is_dir': False}
+            for name, size in sorted(self.files.items()) if os.path.split(name)[0] == path
+            ]
+        if not content:
+            return web.json_response({'code': 500, 'message': "failed get objs: object not found", 'data': None})
+        total = len(content)
+        if per_page > 0:
+            content = content[(page-1)*per_page:page*per_page]
+        return web.json_response({'code': 200, 'message': "success", 'data': {'content': content, 'total': total}})
+
+    async def put(self, request:web.Request):
+        path = unquote(request.headers['File-Path'])
+        size = 0
+        async for chunk in request.content.iter_chunked(1024 * 1024):
+            size += len(chunk)
+        self.bytes_received += size
+        self.files[path] = size
+        self.uploaded[path] = time.monotonic()
+        return web.json_response({'code': 200, 'message': "success", 'data': None})
+
+
+class StubBlrec(StubServer):
+    '假blrec'
+    settings: dict
+
+    def __init__(self):
+        super().__init__()
+        self.settings = {}
+        self.app.router.add_get('/api/v1/tasks/data', self.get_all_data)
+        self.app.router.add_get('/api/v1/tasks/{room_id}/data', self.get_data)
+        self.app.router.add_get('/api/v1/settings', self.get_settings)
+        self.app.router.add_patch('/api/v1/settings', self.set_settings)
+        self.app.router.add_post('/api/v1/validation/cookie', self.validate_cookie)
+
+    @staticmethod
+    def get_room_data(room_id:int):
+        '生成直播间信息'
+        return {
+            'user_info': {'name': f"user_{room_id}", 'uid': room_id},
+            'room_info': {'room_id': room_id, 'title': f"bench_{room_id}", 'live_status': 1},
+            'task_status': {'running_status': "waiting", 'recording_path': None},
+            }
+
+    async def get_all_data(self, request:web.Request):
+        # 没有在录制的直播间
+        return web.json_response([])
+
+    async def get_data(self, request:web.Request):
+        return web.json_response(self.get_room_data(int(request.match_info['room_id'])))
+
+    async def get_settings(self, request:web.Request):
+        return web.json_response(self.settings)
+
+    async def set_settings(self, request:web.Request):
+        self.settings.update(await request.json())
+        return web.json_response(self.settings)
+
+    async def validate_cookie(self, request:web.Request):
+        return web.json_response({'code': 0, 'message': "0", 'data': {'isLogin': True}})
+
+
+def make_file(filename:str, size:int):
+    '生成指定大小的稀疏文件(内容全是0，不占磁盘空间)'
+    os.makedirs(os.path.split(filename)[0], exist_ok=True)
+    with open(filename, 'wb') as f:
+        f.truncate(size)
+
+def make_real_file(filename:str, size:int, chunk_size:int=1024*1024):
+    '生成指定大小的文件(真正写入磁盘)，并清出页缓存'
+    os.makedirs(os.path.split(filename)[0], exist_ok=True)
+    chunk = os.urandom(chunk_size)
+    with open(filename, 'wb') as f:
+        for _ in range(size // chunk_size):
+            f.write(chunk)
+        f.write(chunk[:size % chunk_size])
+        f.flush()
+        os.fsync(f.fileno())
+    drop_cache(filename)
+
+def drop_cache(filename:str):
+    '尽量把文件清出页缓存，让下次读取真正访问磁盘(不支持的系统上什么都不做)'
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+class LoopLagMonitor:
+    '定时sleep，记录事件循环比预期晚了多久(秒)'
+    lags: list
+
+    def __init__(self, interval:float=0.01):
+        self.interval = interval
+        self.lags = []
+        self.__task = None
+
+    async def __run(self):
+        while True:
+            self.__time_start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self.lags.append(time.monotonic() - self.__time_start - self.interval)
+
+    def start(self):
+        '开始记录'
+        self.lags = []
+        self.__time_start = time.monotonic()
+        self.__task = asyncio.create_task(self.__run())
+        return self
+
+    async def stop(self):
+        '停止记录，返回延迟统计(事件循环一直被占用的话，还没醒来的那次也算进去)'
+        if self.__task is not None:
+            lag = time.monotonic() - self.__time_start - self.interval
+            if lag > 0:
+                self.lags.append(lag)
+            self.__task.cancel()
+            await asyncio.gather(self.__task, return_exceptions=True)
+            self.__task = None
+        return get_stats(self.lags)
+
+
+def get_time():
+    '当前UTC时间'
+    return datetime.datetime.now(tz=datetime.timezone.utc)
+
+def get_stats(values:list):
+    '统计一组数值'
+    if not values:
+        return {}
+    values = sorted(values)
+    def percentile(p):
+        return values[min(len(values)-1, int(round(p / 100 * (len(values)-1))))]
+    return {
+        'count': len(values),
+        'min': values[0],
+        'mean': sum(values) / len(values),
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': values[-1],
+        }
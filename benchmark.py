@@ -0,0 +1,82 @@
+import argparse, asyncio, json, shutil, sys, tempfile
+
+from static import logger
+
+import bench
+
+
+def main():
+    parser = argparse.ArgumentParser(description="用本地假alist/blrec服务器跑性能测试")
+    parser.add_argument("names", help=f"要运行的测试({'/'.join(bench.benchmarks)})，默认全部", nargs="*", default=[])
+    parser.add_argument("-o", "--output", help="结果输出文件", default="bench_results.json")
+    parser.add_argument("-w", "--workdir", help="生成测试文件的文件夹，默认使用临时文件夹(结束后删除)", default="")
+    parser.add_argument("--db", help="测试用数据库地址", default="sqlite://:memory:")
+    parser.add_argument("--log-level", help="日志等级", default="WARNING")
+    parser.add_argument("--events", help="webhook: 事件数量", type=int, default=20)
+    parser.add_argument("--rooms", help="webhook/soak: 直播间数量", type=int, default=0)
+    parser.add_argument("--interval", help="webhook: 事件间隔(秒)", type=float, default=0)
+    parser.add_argument("--video-size", help="webhook/soak: 每个视频的(平均)大小(MiB)", type=int, default=0)
+    parser.add_argument("--size", help="upload/readahead: 文件大小(MiB)，默认分别为2048和512", type=int, default=0)
+    parser.add_argument("--read-ahead", help="readahead: 要对比的预读块数", type=int, nargs="+", default=[0, 4])
+    parser.add_argument("--servers", help="upload/scheduler: 服务器数量", type=int, default=0)
+    parser.add_argument("--tasks", help="scheduler: 任务数量", type=int, default=200)
+    parser.add_argument("--files", help="scheduler: 每个任务的文件数", type=int, default=2)
+    parser.add_argument("--segments", help="soak: 每个直播间的录播分段数", type=int, default=4)
+    parser.add_argument("--duration", help="soak: 一天的录播压缩到多少秒", type=float, default=60)
+    parser.add_argument("--latency", help="soak: 假alist的平均附加延迟(秒)", type=float, default=0.05)
+    parser.add_argument("--error-rate", help="soak: 返回5xx的概率", type=float, default=0.05)
+    parser.add_argument("--throttle-rate", help="soak: 返回429的概率", type=float, default=0.05)
+    parser.add_argument("--truncate-rate", help="soak: 上传中途断开的概率", type=float, default=0.05)
+    parser.add_argument("--reset-rate", help="soak: 直接断开连接的概率", type=float, default=0.02)
+    parser.add_argument("--retry-after", help="soak: 429时返回的Retry-After(秒)", type=float, default=1)
+    parser.add_argument("--seed", help="soak: 随机数种子", type=int, default=0)
+    parser.add_argument("--import-budget", help="imports: 模块导入耗时预算，例如--import-budget client=0.3", action="append", default=[])
+    parser.add_argument("--set", help="临时修改配置，例如--set server.retry_backoff=2 --set queue.retry_interval=5", action="append", default=[])
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+
+    faults = {
+        'latency': args.latency,
+        'error_rate': args.error_rate,
+        'throttle_rate': args.throttle_rate,
+        'truncate_rate': args.truncate_rate,
+        'reset_rate': args.reset_rate,
+        'retry_after': args.retry_after,
+    }
+    params = {
+        'webhook': {'events': args.events, 'size': args.video_size or 64, 'rooms': args.rooms or 4, 'interval': args.interval},
+        'upload': {'size': args.size or 2048, 'servers': args.servers or 1},
+        'readahead': {'size': args.size or 512, 'read_ahead': args.read_ahead},
+        'scheduler': {'tasks': args.tasks, 'files': args.files, 'servers': args.servers or 2},
+        'imports': {'budgets': {'client': 0.5, 'server': 2, **{
+            name: float(value) for name, value in (item.split('=', 1) for item in args.import_budget)
+            }}},
+        'soak': {
+            'rooms': args.rooms or 6, 'segments': args.segments, 'size': args.video_size or 32,
+            'duration': args.duration, 'faults': faults, 'seed': args.seed,
+            },
+    }
+    bench.apply_overrides(args.set)
+    names = args.names or bench.default_benchmarks
+    for name in names:
+        if name not in bench.benchmarks:
+            parser.error(f"Unknown benchmark: {name}")
+    workdir = args.workdir or tempfile.mkdtemp(prefix="autorec_bench_")
+    try:
+        results = asyncio.run(bench.run(names, workdir, args.db, params))
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    data = bench.write_results(results, args.output)
+    print(json.dumps(data['benchmarks'], indent=2, ensure_ascii=False))
+    logger.info(f"Results written to {args.output}")
+    failed = [name for name, res in results.items() if res.get('ok') is False]
+    if failed:
+        logger.error(f"Failed benchmarks: {failed}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
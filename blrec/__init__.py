@@ -1,14 +1,19 @@
-import asyncio, traceback, json, os
+import asyncio, traceback, json, os, time
 
-from aiohttp import ClientSession, ClientError, ClientTimeout, client_exceptions
+from aiohttp import ClientError, ClientTimeout, client_exceptions
 from urllib.parse import quote
 
+import metrics
+import network
 from static import config, logger
+from static.utils import TTLCache
 
 async def send_request(timeout=20, **kwargs):
     '发送请求'
-    async with ClientSession(timeout=ClientTimeout(total=timeout)) as session:
-        async with session.request(**kwargs) as res:
+    async with network.use_session(kwargs['url']) as session:
+        time_start = time.monotonic()
+        async with session.request(timeout=ClientTimeout(total=timeout), **kwargs) as res:
+            metrics.observe_api('blrec', kwargs['url'], time_start)
             try:
                 response = await res.json()
             except client_exceptions.ContentTypeError:
@@ -30,8 +35,8 @@ async def set_blrec(data: dict):
     resp = await send_request(timeout=20, method="PATCH", url=url, json=body)
     assert resp
 
-async def get_blrec_data(room_id=-1, page=1, size=100, select="all"):
-    '获取blrec信息'
+async def fetch_blrec_data(room_id=-1, page=1, size=100, select="all"):
+    '从blrec获取信息(不经过缓存)'
     params = {
         "select": select,
         "size": size,
@@ -45,6 +50,111 @@ async def get_blrec_data(room_id=-1, page=1, size=100, select="all"):
 
     return response_json
 
+
+class RoomDataCache:
+    '按直播间缓存的blrec信息，同时请求同一个直播间的话共用一次请求，收到webhook事件时更新'
+    # 直播间状态会变化的事件(RoomChangeEvent直接用事件里的信息更新)
+    INVALIDATING_EVENTS = (
+        'LiveBeganEvent', 'LiveEndedEvent',
+        'RecordingStartedEvent', 'RecordingFinishedEvent', 'RecordingCancelledEvent',
+        )
+    __data: TTLCache|None
+    __pending: dict
+    __generation: int
+
+    def __init__(self):
+        self.__data = None
+        self.__pending = {}
+        self.__generation = 0
+
+    def __cache(self):
+        '缓存第一次用到时才按配置创建'
+        if self.__data is None:
+            self.__data = TTLCache(ttl=config.blrec['cache_ttl'], maxsize=256)
+        return self.__data
+
+    async def get(self, room_id=-1, page=1, size=100, select="all"):
+        '获取blrec信息(优先使用缓存)'
+        key = (room_id, page, size, select)
+        data = self.__cache().get(key)
+        if data is not None:
+            return data
+
+        # 同时请求的话共用一次请求
+        task = self.__pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self.__fetch(key))
+            self.__pending[key] = task
+            task.add_done_callback(lambda _: self.__remove_pending(key, task))
+        return await asyncio.shield(task)
+
+    def __remove_pending(self, key:tuple, task):
+        if self.__pending.get(key) is task:
+            del self.__pending[key]
+
+    async def __fetch(self, key:tuple):
+        '请求并写入缓存，请求期间缓存被清除过的话不写入'
+        generation = self.__generation
+        data = await fetch_blrec_data(*key)
+        # 请求失败时返回的是{}，不缓存；没有直播间在录制时返回的[]可以缓存
+        cache = self.__cache()
+        if (data or isinstance(data, list)) and cache.ttl > 0 and self.__generation == generation:
+            cache.set(key, data)
+        return data
+
+    def __drop(self, rooms:set):
+        '清除这些直播间的缓存，正在进行的请求结果也不再使用'
+        self.__generation += 1
+        cache = self.__cache()
+        for key in [key for key in cache.keys() if key[0] in rooms]:
+            cache.pop(key)
+        for key in [key for key in self.__pending if key[0] in rooms]:
+            del self.__pending[key]
+
+    def invalidate(self, room_id=-1):
+        '清除直播间的缓存(所有直播间的列表也一起清除)，room_id=-1时全部清除'
+        if room_id == -1:
+            self.__drop({key[0] for key in [*self.__cache().keys(), *self.__pending]})
+        else:
+            self.__drop({room_id, -1})
+
+    def update_room_info(self, room_info:dict):
+        '用事件里的直播间信息更新缓存(所有直播间的列表直接清除)'
+        room_id = room_info['room_id']
+        cache = self.__cache()
+        for key in cache.keys():
+            data = cache.get(key)
+            if key[0] == room_id and key[3] == "all" and data:
+                cache.set(key, {**data, 'room_info': room_info})
+        self.__drop({-1})
+
+    def apply_settings(self):
+        '按当前配置修改缓存时间并清空缓存(blrec地址可能也改了)'
+        if self.__data is None:
+            return
+        self.__data.ttl = config.blrec['cache_ttl']
+        self.invalidate()
+
+    def handle_event(self, event_type:str, data:dict):
+        '根据webhook事件更新缓存'
+        room_info = data.get('room_info') or {}
+        room_id = data.get('room_id', room_info.get('room_id', -1))
+        if event_type == 'RoomChangeEvent' and 'room_id' in room_info:
+            self.update_room_info(room_info)
+        elif event_type in self.INVALIDATING_EVENTS:
+            self.invalidate(room_id)
+        else:
+            return
+        logger.debug(f"Blrec data cache of room {room_id} updated by {event_type}")
+
+room_cache = RoomDataCache()
+
+async def get_blrec_data(room_id=-1, page=1, size=100, select="all", use_cache=True):
+    '获取blrec信息'
+    if use_cache:
+        return await room_cache.get(room_id, page, size, select)
+    return await fetch_blrec_data(room_id, page, size, select)
+
 async def check_blrec_cookies(cookies:str):
     '通过blrec的API检查cookies'
     # logger.info(cookies)
@@ -1,7 +1,7 @@
 from aiohttp import ClientSession, ClientTimeout
 
+import static
 from static import logger, Config
-from cookies_checker.utils import login, refresh_cookies, sync_cookies
 
 import argparse, asyncio, json
 
@@ -38,7 +38,7 @@ async def add_task(url, local_dir, config_file, now=False):
     data = await request(method="post", url=url, params=data)
     logger.info("Autobackup task created.")
     # logger.info(data)
-    print(data['data'])
+    print_counts(data['data'])
 
 async def dump_load_reload(url, filename, mode="dump"):
     '导出/导入任务列表或重载配置'
@@ -62,7 +62,8 @@ async def dump_load_reload(url, filename, mode="dump"):
         logger.info(f"Reloaded {filename}.")
     else:
         return
-    print(data['data'])
+    if data['data'] is not None:
+        print_counts(data['data'])
 
 
 async def show_del_retry(url, index:int|None=-1, mode="show", is_all=False):
@@ -81,20 +82,67 @@ async def show_del_retry(url, index:int|None=-1, mode="show", is_all=False):
         data = await request(method="delete", url=f"{url}/autobackup", params=params)
         logger.info(f"Deleted task {index}.")
     elif mode == "show":
-        data = await request(method="get", url=f"{url}/autobackup")
-        logger.info(f"Fetched tasks.")
+        await show_tasks(url)
+        return
     else:
         return
-    print(data['data'])
+    print_counts(data['data'])
+
+
+async def show_tasks(url, status=""):
+    '分页获取并显示任务列表'
+    params = {'status': status, 'cursor': 0}
+    while True:
+        data = await request(method="get", url=f"{url}/autobackup", params=params)
+        page = data['data']
+        for i in page['tasks']:
+            print("ID: {} \tStatus: {} \tScheduled Time: {} \tLocal dir:{} \tRemote dir:{} ".format(
+                i['id'],
+                i['status'],
+                i['time'],
+                i['local_dir'],
+                f"{i['url_alist']}{i['remote_dir']}"
+            ))
+        if page['next_cursor'] is None:
+            break
+        params['cursor'] = page['next_cursor']
+    logger.info(f"Fetched tasks.")
+    print_counts(page['counts'])
+
+
+async def show_retry_jobs(url, index:int=-1, mode="show", is_all=False):
+    '显示或重试失败的上传队列任务'
+    if mode == "show":
+        data = await request(method="get", url=f"{url}/queue")
+        for i in data['data']['failed']:
+            print("ID: {} \tKind: {} \tAttempts: {} \tPayload: {} \tLast error: {}".format(
+                i['id'], i['kind'], i['attempts'], i['payload'], i['last_error'].strip().splitlines()[-1:]
+            ))
+        print_counts(data['data']['counts'])
+    elif mode == "retry":
+        data = await request(method="post", url=f"{url}/queue/retry", params={'id': index, 'all': str(is_all)})
+        logger.info(f"Retried job {index}.")
+        print_counts(data['data'])
+
+
+def print_counts(counts:dict):
+    '显示各状态的任务数量'
+    print(" \t".join(f"{status}: {count}" for status, count in counts.items()))
 
 
 async def __handle_cookies(args):
-    if args.login:
-        await login(args.tv)
-    elif args.check:
-        await refresh_cookies(args.forced)
-    elif args.sync:
-        await sync_cookies(credential=None)
+    # 只有cookies相关的命令才需要bilibili_api，用到时再导入
+    import network
+    from cookies_checker.utils import login, refresh_cookies, sync_cookies
+    try:
+        if args.login:
+            await login(args.tv)
+        elif args.check:
+            await refresh_cookies(args.forced)
+        elif args.sync:
+            await sync_cookies(credential=None)
+    finally:
+        await network.close()
 
 async def __handle_backup(args):
     config_file = args.config if args.config else "settings.toml"
@@ -102,7 +150,7 @@ async def __handle_backup(args):
     url = f"http://{config.app['host_server']}:{config.app['port_server']}"
 
     if args.show:
-        await show_del_retry(url, mode="show")
+        await show_tasks(url, status=args.status)
     elif args.add != "":
         await add_task(url, config_file=config_file, local_dir=args.add)
     elif args.dump != "":
@@ -122,6 +170,18 @@ async def __handle_backup(args):
     elif args.upload  != "":
         await add_task(url, config_file=config_file, local_dir=args.upload, now=True)
 
+async def __handle_queue(args):
+    config = Config(args.config)
+    url = f"http://{config.app['host_server']}:{config.app['port_server']}"
+
+    if args.show:
+        await show_retry_jobs(url, mode="show")
+    elif args.retry != "":
+        if args.retry == "all":
+            await show_retry_jobs(url, -1, is_all=True, mode="retry")
+        else:
+            await show_retry_jobs(url, int(args.retry), is_all=False, mode="retry")
+
 async def __handle_config(args):
     if args.reload:
         config = Config(args.reload)
@@ -158,6 +218,7 @@ def main():
 
     p_autobackup = sp.add_parser("backup", help="自动备份任务相关")
     p_autobackup.add_argument("-s", "--show", help="显示所有任务", action="store_true", default=False)
+    p_autobackup.add_argument("--status", help="显示任务时只显示指定状态", default="")
     p_autobackup.add_argument("-a", "--add", help="将指定文件夹添加为备份任务", default="")
     p_autobackup.add_argument("-j", "--dump", help="将当前所有备份任务导出为json", default="")
     p_autobackup.add_argument("-l", "--load", help="从文件中载入备份任务(保留现有)", default="")
@@ -166,7 +227,13 @@ def main():
     p_autobackup.add_argument("-d", "--delete", help="删除指定备份任务(可以是all)", default="")
     p_autobackup.set_defaults(func=lambda x:asyncio.run(__handle_backup(x)))
 
+    p_queue = sp.add_parser("queue", help="上传队列相关")
+    p_queue.add_argument("-s", "--show", help="显示失败的任务和各状态的任务数量", action="store_true", default=False)
+    p_queue.add_argument("-t", "--retry", help="重试指定的失败任务(可以是all)", default="")
+    p_queue.set_defaults(func=lambda x:asyncio.run(__handle_queue(x)))
+
     args = p.parse_args()
+    static.init()
     args.func(args)
 
 if __name__ == "__main__":
@@ -8,15 +8,27 @@ from blrec import get_blrec_data
 
 # from .utils import add_subtitles_all
 
+JOB_ID = "refresh_cookies"
+scheduler = None
+
 async def init():
     '初始化'
+    global scheduler
     interval = config.cookies['check_interval']
     scheduler = AsyncIOScheduler()
-    scheduler.add_job(scheduled_refresh, trigger="interval", seconds=interval)
+    scheduler.add_job(scheduled_refresh, trigger="interval", seconds=interval, id=JOB_ID)
     scheduler.start()
     logger.debug(f"Cookies scheduler started (Interval: {interval}s)")
     return scheduler
 
+def reschedule():
+    '按当前配置修改检查间隔'
+    if scheduler is None:
+        return
+    interval = config.cookies['check_interval']
+    scheduler.reschedule_job(JOB_ID, trigger="interval", seconds=interval)
+    logger.debug(f"Cookies scheduler rescheduled (Interval: {interval}s)")
+
 async def scheduled_refresh():
     '定时操作'
     if await get_blrec_data(room_id=-1, select="recording"):
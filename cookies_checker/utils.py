@@ -1,15 +1,15 @@
 import json, asyncio, traceback
 
-import bilibili_api as bili
-from bilibili_api import login_v2, request_settings
-from bilibili_api.login_v2 import QrCodeLoginEvents
-from bilibili_api.utils.network import get_buvid, get_bili_ticket
-
+from typing import TYPE_CHECKING
 from loguru import logger
 
 from static import config
 from blrec import check_blrec_cookies, set_blrec
 
+# bilibili_api导入很慢，用到时再导入
+if TYPE_CHECKING:
+    import bilibili_api as bili
+
 
 def cookie_dict2str(data:dict):
     'cookie_dict转换为字符串'
@@ -20,12 +20,13 @@ def cookie_dict2str(data:dict):
 
 def load_credential():
     '从json导入credential'
+    import bilibili_api as bili
     with open("credential.json", 'r') as f:
         credential_dict = json.load(f)
     credential = bili.Credential.from_cookies(credential_dict)
     return credential, credential_dict
 
-def dump_credential(credential:bili.Credential):
+def dump_credential(credential:'bili.Credential'):
     '导出credential到json'
     credential_dict = credential.get_cookies()
     with open("credential.json", 'w') as f:
@@ -33,6 +34,8 @@ def dump_credential(credential:bili.Credential):
 
 async def login(is_tv=False):
     '登录账号'
+    from bilibili_api import login_v2
+    from bilibili_api.login_v2 import QrCodeLoginEvents
     if is_tv:
         qr = login_v2.QrCodeLogin(platform=login_v2.QrCodeLoginChannel.TV)
     else:
@@ -95,8 +98,9 @@ async def refresh_cookies(is_forced=False, silent=False):
     # 保存并同步
     await sync_cookies(credential=credential)
 
-async def sync_cookies(credential:bili.Credential|None=bili.Credential()):
-    '保存cookies并同步到blrec'
+async def sync_cookies(credential:'bili.Credential|None'=None):
+    '保存cookies并同步到blrec，credential为空时从credential.json读取'
+    from bilibili_api.utils.network import get_buvid
     if not credential:
         credential, credential_dict = load_credential()
     else:
@@ -117,8 +121,9 @@ async def sync_cookies(credential:bili.Credential|None=bili.Credential()):
     logger.info(f"New cookies: {new_cookies}")
     print("Cookies sync complete.")
 
-async def try_bili_ticket(credential:bili.Credential):
+async def try_bili_ticket(credential:'bili.Credential'):
     '尝试获取bili_ticket'
+    from bilibili_api.utils.network import get_bili_ticket
     try:
         bili_ticket, bili_ticket_expires = await get_bili_ticket(credential)
     except Exception:
@@ -1,19 +1,27 @@
+import inspect
 import tortoise
 from tortoise import Tortoise
 from static import config
 from urllib.parse import quote
 from .models import *
+from .utils import export_legacy, import_legacy, sync_servers, prune_events
 
-async def init_db():
-    '初始化数据库'
+def get_db_url():
+    '数据库地址，设置了db.url时优先使用'
+    if config.db.get('url'):
+        return config.db['url']
     user = quote(config.db['pg_user'])
     passwd = quote(config.db['pg_password'])
     db_host = quote(config.db['pg_host'])
     db_port = config.db['pg_port']
     database = quote(config.db['pg_database'])
+    return f"postgres://{user}:{passwd}@{db_host}:{db_port}/{database}"
+
+async def init_db():
+    '初始化数据库'
     config_db = {
             "connections": {
-                "autorec_db": f"postgres://{user}:{passwd}@{db_host}:{db_port}/{database}"
+                "autorec_db": get_db_url()
             },
             "apps": {
                 "autorec_app": {
@@ -22,9 +30,17 @@ async def init_db():
                 }
             },
         }
-    await Tortoise.init(config_db)
+    # 新版tortoise默认只在当前协程里可见，FastAPI的lifespan和请求不在同一个协程里
+    if '_enable_global_fallback' in inspect.signature(Tortoise.init).parameters:
+        await Tortoise.init(config_db, _enable_global_fallback=True)
+    else:
+        await Tortoise.init(config_db)
+    # 旧版表结构的数据先导出再重建
+    legacy_data = await export_legacy()
     await Tortoise.generate_schemas(safe=True)
+    await import_legacy(legacy_data)
+    await prune_events(force=True)
 
 async def close():
     '关闭数据库连接'
-    await tortoise.connections.close_all(discard=False)
+    await Tortoise.close_connections()
@@ -1,9 +1,61 @@
 from tortoise.models import Model
-from tortoise.fields import SmallIntField, IntField, BigIntField, FloatField, CharField, TextField, DatetimeField, BooleanField, JSONField
+from tortoise.fields import SmallIntField, IntField, BigIntField, FloatField, CharField, TextField, DatetimeField, BooleanField, JSONField, UUIDField, ForeignKeyField, CASCADE
 # from urllib.parse import quote, unquote
 
+class BackupServer(Model):
+    url_alist = CharField(max_length=255)
+    username = CharField(max_length=255)
+    remote_dir = TextField()
+    settings_alist = JSONField()
+    settings_hash = CharField(max_length=64)
+
+    class Meta:
+        unique_together = (("url_alist", "username", "remote_dir"),)
+
+
 class BackupTask(Model):
     time = DatetimeField()
     local_dir = TextField()
-    settings_alist = JSONField()
+    server = ForeignKeyField("autorec_app.BackupServer", related_name="tasks", on_delete=CASCADE)
+    status = CharField(max_length=35)
+
+    class Meta:
+        indexes = (("status", "time"),)
+        unique_together = (("local_dir", "server", "time"),)
+
+
+class BackupFile(Model):
+    task = ForeignKeyField("autorec_app.BackupTask", related_name="files", on_delete=CASCADE)
+    filename = TextField()
+    size = BigIntField(default=0)
     status = CharField(max_length=35)
+    bytes_sent = BigIntField(default=0)
+    attempts = SmallIntField(default=0)
+    last_error = TextField(default="")
+
+    class Meta:
+        unique_together = (("task", "filename"),)
+
+
+class UploadJob(Model):
+    kind = CharField(max_length=35)
+    payload = JSONField()
+    host = CharField(max_length=255, default="")
+    key = CharField(max_length=1024, default="", index=True)
+    status = CharField(max_length=35)
+    attempts = SmallIntField(default=0)
+    next_time = DatetimeField()
+    last_error = TextField(default="")
+
+
+class FileHash(Model):
+    path = CharField(max_length=1024, unique=True)
+    size = BigIntField()
+    mtime = FloatField()
+    hashes = JSONField()
+
+
+class WebhookEvent(Model):
+    id = UUIDField(pk=True)
+    type = CharField(max_length=64)
+    time = DatetimeField(auto_now_add=True)
@@ -0,0 +1,259 @@
+import datetime, hashlib, json, os, time, traceback
+
+from collections import OrderedDict
+from tortoise import Tortoise
+
+from static import config, logger
+from .models import BackupTask, BackupServer, BackupFile, FileHash, UploadJob, WebhookEvent
+
+LEGACY_FILENAME = "db_legacy_backup.json"
+
+
+def hash_settings(settings:dict):
+    '服务器设置的稳定哈希，用于查重'
+    s = json.dumps(settings, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(s.encode('utf-8')).hexdigest()
+
+# (alist地址, 用户名, 远程文件夹) -> (设置哈希, 服务器id)
+server_ids = {}
+
+async def get_server_id(settings_alist:dict):
+    '''
+    获取备份服务器在数据库里的id，没有就新建
+    设置有变化时原地更新，还在等待的任务到点时就会用上新的密码之类的设置
+    '''
+    key = (settings_alist['url_alist'], settings_alist.get('username', ''), settings_alist['remote_dir'])
+    settings_hash = hash_settings(settings_alist)
+    item = server_ids.get(key)
+    if item and item[0] == settings_hash:
+        return item[1]
+
+    server, is_created = await BackupServer.get_or_create(
+        url_alist=key[0], username=key[1], remote_dir=key[2],
+        defaults={'settings_alist': settings_alist, 'settings_hash': settings_hash}
+        )
+    if not is_created and server.settings_hash != settings_hash:
+        server.settings_alist = settings_alist
+        server.settings_hash = settings_hash
+        await server.save(update_fields=['settings_alist', 'settings_hash'])
+        logger.info(f"Settings of backup server {server.id} updated")
+    server_ids[key] = (settings_hash, server.id)
+    return server.id
+
+async def sync_servers(settings_autobackup:dict):
+    '把配置里的备份服务器写入数据库，删掉配置里已经没有、也没有任务用到的'
+    ids = {await get_server_id(settings_alist) for settings_alist in settings_autobackup['servers']}
+    ids.update(await BackupTask.all().distinct().values_list('server_id', flat=True))
+    count = await BackupServer.filter(id__not_in=ids).delete()
+    if count:
+        for key in [key for key, item in server_ids.items() if item[1] not in ids]:
+            del server_ids[key]
+        logger.debug(f"Removed {count} unused backup servers")
+
+async def get_file_hashes(filename:str):
+    '获取缓存的本地文件哈希，文件大小或修改时间变了就当作没有'
+    stat = os.stat(filename)
+    try:
+        item = await FileHash.filter(
+            path=os.path.abspath(filename), size=stat.st_size, mtime=stat.st_mtime
+            ).first()
+    except Exception:
+        # 没有初始化数据库时(例如manual_upload.py)不使用缓存
+        logger.debug(f"Failed to get hashes of {filename}: {traceback.format_exc()}")
+        return {}
+    return item.hashes if item else {}
+
+async def save_file_hashes(filename:str, size:int, mtime:float, hashes:dict):
+    '缓存本地文件哈希，size和mtime是计算哈希时的值'
+    try:
+        await FileHash.update_or_create(
+            path=os.path.abspath(filename),
+            defaults={'size': size, 'mtime': mtime, 'hashes': hashes}
+            )
+    except Exception:
+        logger.debug(f"Failed to save hashes of {filename}: {traceback.format_exc()}")
+
+# 最近收到的webhook事件id(按收到顺序)
+seen_events = OrderedDict()
+last_prune_time = 0
+
+async def check_event(event_id:str, event_type:str):
+    '记录webhook事件，返回是否第一次收到(重复的事件不需要再处理)'
+    event_id = str(event_id)
+    if event_id in seen_events:
+        seen_events.move_to_end(event_id)
+        return False
+    # 先记在内存里，同时收到的重复事件不会都去查数据库
+    seen_events[event_id] = event_type
+    while len(seen_events) > config.app['webhook_dedupe_size']:
+        seen_events.popitem(last=False)
+
+    try:
+        _, is_created = await WebhookEvent.get_or_create(id=event_id, defaults={'type': event_type})
+    except Exception:
+        # 数据库出错时宁可重复处理，也不丢事件
+        logger.warning(f"Failed to save webhook event {event_id}: {traceback.format_exc()}")
+        return True
+    await prune_events()
+    return is_created
+
+async def forget_event(event_id:str):
+    '事件处理失败时删除记录，让blrec重试的时候能重新处理'
+    event_id = str(event_id)
+    seen_events.pop(event_id, None)
+    try:
+        await WebhookEvent.filter(id=event_id).delete()
+    except Exception:
+        logger.warning(f"Failed to delete webhook event {event_id}: {traceback.format_exc()}")
+
+async def prune_events(force=False):
+    '删除太久以前的webhook事件记录(最多每小时一次)'
+    global last_prune_time
+    if not force and time.monotonic() - last_prune_time < 3600:
+        return
+    last_prune_time = time.monotonic()
+    time_limit = datetime.datetime.now(tz=datetime.timezone.utc) - datetime.timedelta(days=config.app['webhook_dedupe_days'])
+    count = await WebhookEvent.filter(time__lt=time_limit).delete()
+    if count:
+        logger.debug(f"Pruned {count} webhook events older than {time_limit}")
+
+def parse_time(value):
+    '把导出的时间(时间戳或ISO字符串)转换为带时区的datetime'
+    if isinstance(value, str):
+        t = datetime.datetime.fromisoformat(value)
+    else:
+        t = datetime.datetime.fromtimestamp(value, tz=datetime.timezone.utc)
+    if t.tzinfo is None:
+        t = t.replace(tzinfo=datetime.timezone.utc)
+    return t
+
+async def get_columns(table:str):
+    '获取数据库里已有的表的列名，表不存在时返回空集合'
+    conn = Tortoise.get_connection("autorec_db")
+    if conn.capabilities.dialect == "sqlite":
+        rows = await conn.execute_query_dict(f'PRAGMA table_info("{table}")')
+        return {row['name'] for row in rows}
+    else:
+        rows = await conn.execute_query_dict(
+            "SELECT column_name FROM information_schema.columns WHERE table_name = $1", [table]
+            )
+        return {row['column_name'] for row in rows}
+
+async def get_unique_columns(table:str):
+    '获取数据库里已有的表的唯一约束，返回[列名集合]'
+    conn = Tortoise.get_connection("autorec_db")
+    if conn.capabilities.dialect == "sqlite":
+        result = []
+        for index in await conn.execute_query_dict(f'PRAGMA index_list("{table}")'):
+            if not index['unique'] or index['origin'] == 'pk':
+                continue
+            name = index['name']
+            rows = await conn.execute_query_dict(f'PRAGMA index_info("{name}")')
+            result.append({row['name'] for row in rows})
+        return result
+    else:
+        rows = await conn.execute_query_dict(
+            "SELECT array_agg(a.attname) AS columns FROM pg_index i "
+            "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+            "WHERE i.indrelid = $1::regclass AND i.indisunique AND NOT i.indisprimary "
+            "GROUP BY i.indexrelid", [table]
+            )
+        return [set(row['columns']) for row in rows]
+
+async def is_outdated(model):
+    '检查表的列和唯一约束是否和模型一致，表不存在时不算'
+    table = model._meta.db_table
+    columns = await get_columns(table)
+    if not columns:
+        return False
+    if columns != set(model._meta.fields_db_projection.values()):
+        return True
+    unique_columns = await get_unique_columns(table)
+    for fields in model._meta.unique_together:
+        expected = {
+            f"{name}_id" if name in model._meta.fk_fields else model._meta.fields_db_projection[name]
+            for name in fields
+            }
+        if expected not in unique_columns:
+            return True
+    return False
+
+async def export_legacy():
+    '表结构和模型不一致时，导出旧数据并删除旧表，返回{表名: 数据}'
+    conn = Tortoise.get_connection("autorec_db")
+    if os.path.exists(LEGACY_FILENAME):
+        # 上次迁移没完成，接着导入
+        logger.warning(f"Found unfinished migration, loading {LEGACY_FILENAME}...")
+        with open(LEGACY_FILENAME, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    legacy_data = {}
+    models = [BackupServer, BackupTask, BackupFile, UploadJob]
+    outdated = [model for model in models if await is_outdated(model)]
+    if BackupServer in outdated and BackupTask not in outdated and await get_columns(BackupTask._meta.db_table):
+        # 服务器id会变，任务也要跟着迁移
+        outdated.insert(1, BackupTask)
+    for model in outdated:
+        table = model._meta.db_table
+        logger.info(f"Migrating table {table}...")
+        rows = await conn.execute_query_dict(f'SELECT * FROM "{table}"')
+        legacy_data[table] = [
+            {k: v.timestamp() if isinstance(v, datetime.datetime) else v for k, v in row.items()}
+            for row in rows
+            ]
+
+    if legacy_data:
+        # 先保存到文件，防止迁移中途出错丢数据
+        with open(LEGACY_FILENAME, 'w', encoding='utf-8') as f:
+            json.dump(legacy_data, f, ensure_ascii=False)
+        cascade = "" if conn.capabilities.dialect == "sqlite" else " CASCADE"
+        # 任务id会变，旧的文件上传记录没法再对应上
+        if BackupTask._meta.db_table in legacy_data:
+            await conn.execute_script(f'DROP TABLE IF EXISTS "{BackupFile._meta.db_table}"')
+        # 先删引用别的表的表
+        for table in reversed(list(legacy_data.keys())):
+            await conn.execute_script(f'DROP TABLE IF EXISTS "{table}"{cascade}')
+    return legacy_data
+
+async def import_legacy(legacy_data:dict):
+    '把导出的旧数据写入新表'
+    if not legacy_data:
+        return
+    try:
+        # 新版的任务只记了服务器id，要从旧的服务器表里找回设置
+        servers = {
+            row['id']: row['settings_alist']
+            for row in legacy_data.get(BackupServer._meta.db_table, [])
+            }
+        for row in legacy_data.get(BackupTask._meta.db_table, []):
+            if 'settings_alist' in row:
+                settings_alist = row['settings_alist']
+            else:
+                settings_alist = servers[row['server_id']]
+            if isinstance(settings_alist, str):
+                settings_alist = json.loads(settings_alist)
+            await BackupTask.get_or_create(
+                local_dir=row['local_dir'],
+                server_id=await get_server_id(settings_alist),
+                time=parse_time(row['time']),
+                defaults={'status': row['status']},
+                )
+        # 任务id没变时保留文件上传记录，只保留新表里还有的列
+        if BackupTask._meta.db_table not in legacy_data:
+            fields = BackupFile._meta.fields_db_projection
+            for row in legacy_data.get(BackupFile._meta.db_table, []):
+                await BackupFile.create(**{k: row[v] for k, v in fields.items() if v in row and k != 'id'})
+        # 队列里的任务只保留新表里还有的列
+        fields = UploadJob._meta.fields_db_projection
+        for row in legacy_data.get(UploadJob._meta.db_table, []):
+            job = {k: row[v] for k, v in fields.items() if v in row and k != 'id'}
+            job['next_time'] = parse_time(job['next_time'])
+            if isinstance(job['payload'], str):
+                job['payload'] = json.loads(job['payload'])
+            await UploadJob.create(**job)
+    except Exception:
+        logger.error(f"Migration failed, legacy data is kept in {LEGACY_FILENAME}: {traceback.format_exc()}")
+        raise
+    else:
+        os.remove(LEGACY_FILENAME)
+        logger.info("Migration completed.")
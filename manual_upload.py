@@ -1,6 +1,7 @@
-import autorec
+import alist, network
 import getopt, os, sys, toml
-from static import config, logger
+import static
+from static import logger
 from tortoise import run_async
 
 def usage():
@@ -12,6 +13,27 @@ def usage():
 """)
     quit()
 
+async def upload(local_dir:str, filenames:list, settings_autobackup:dict):
+    '上传到所有备份服务器'
+    last_dir = os.path.split(os.path.split(local_dir)[0])[1]
+    for settings_alist in settings_autobackup['servers']:
+        dest_dir = settings_alist['remote_dir']
+        # 获取token(同一服务器只登录一次)
+        token = await alist.get_alist_token(settings_alist)
+
+        # 上传
+        total = len(filenames)
+        for idx, filename in enumerate(filenames):
+            local_filename = os.path.join(local_dir, filename)
+            dest_filename = os.path.join(dest_dir, last_dir, filename)
+            logger.info("Uploading: {} -> {} ({}/{})".format(local_filename, dest_filename, idx+1, total))
+            await alist.upload_alist(settings_alist, token, local_filename, dest_filename)
+    # 等远程文件确认完整后再删除本地文件
+    if len(alist.removal_queue):
+        logger.info("Verifying uploaded files before removing them...")
+        await alist.removal_queue.wait()
+    await network.close()
+
 def main():
     # 初始化
     local_dir = ""
@@ -34,30 +56,16 @@ def main():
     
     # 获取文件名，去除文件夹
     filenames = os.listdir(local_dir)
-    last_dir = os.path.split(os.path.split(local_dir)[0])[1]
     for idx, filename in enumerate(filenames):
         if os.path.isdir(os.path.join(local_dir, filename)):
             del filenames[idx]
     
     # 读取配置
-    if config_file != "settings.toml":
-        config.load(config_file)
+    config = static.init(config_file)
     settings_autobackup = config.autobackup
 
-    # 读取备份设置
-    for settings_alist in settings_autobackup['servers']:
-        dest_dir = settings_alist['remote_dir']
-        # 获取token
-        session = autorec.AutoRecSession()
-        token = run_async(session.get_alist_token(settings_alist))
-
-        # 上传
-        total = len(filenames)
-        for idx, filename in enumerate(filenames):
-            local_filename = os.path.join(local_dir, filename)
-            dest_filename = os.path.join(dest_dir, last_dir, filename)
-            logger.log("Uploading: {} -> {} ({}/{})".format(local_filename, dest_filename, idx+1, total))
-            run_async(session.upload_alist(settings_alist, token, local_filename, dest_filename))
+    # 上传
+    run_async(upload(local_dir, filenames, settings_autobackup))
     
 if __name__ == "__main__":
     main()
@@ -0,0 +1,87 @@
+import re, time
+
+from urllib.parse import urlsplit
+
+from .utils import Counter, Gauge, Histogram
+
+
+# 上传
+upload_bytes = Counter(
+    'autorec_upload_bytes_total', "Bytes of files uploaded successfully", ['server']
+    )
+upload_sent_bytes = Counter(
+    'autorec_upload_sent_bytes_total', "Bytes sent to alist, including failed attempts", ['server']
+    )
+upload_seconds = Histogram(
+    'autorec_upload_seconds', "Time taken to upload a file", ['server'],
+    buckets=(1, 5, 15, 60, 300, 900, 1800, 3600, 7200, 14400)
+    )
+upload_throughput = Gauge(
+    'autorec_upload_throughput_bytes', "Average speed of the latest upload (bytes/s)", ['server']
+    )
+
+# API请求
+api_seconds = Histogram(
+    'autorec_api_request_seconds', "Latency of API requests", ['service', 'host', 'api']
+    )
+alist_retries = Counter(
+    'autorec_alist_retries_total', "Retried alist requests", ['server', 'reason']
+    )
+alist_failures = Counter(
+    'autorec_alist_failures_total', "Alist requests that failed after all retries", ['server']
+    )
+
+# 任务和调度
+backup_tasks = Gauge(
+    'autorec_backup_tasks', "Number of backup tasks", ['status']
+    )
+upload_jobs = Gauge(
+    'autorec_upload_jobs', "Number of jobs in the upload queue", ['status']
+    )
+webhook_seconds = Histogram(
+    'autorec_webhook_seconds', "Time taken to handle a blrec webhook", ['type']
+    )
+scheduler_lag = Histogram(
+    'autorec_scheduler_lag_seconds', "Delay between the scheduled time and the actual start of backup tasks",
+    buckets=(0.1, 0.5, 1, 5, 15, 60, 300, 900, 3600)
+    )
+
+registry = [
+    upload_bytes, upload_sent_bytes, upload_seconds, upload_throughput,
+    api_seconds, alist_retries, alist_failures,
+    backup_tasks, upload_jobs, webhook_seconds, scheduler_lag,
+    ]
+
+
+def get_server(url:str):
+    '用作标签的服务器名(协议+主机)'
+    res = urlsplit(url)
+    return f"{res.scheme}://{res.netloc}"
+
+def get_api(url:str):
+    '用作标签的API路径，路径里的数字(房间号等)合并成一个'
+    return re.sub(r'/\d+(?=/|$)', '/{id}', urlsplit(url).path)
+
+def observe_api(service:str, url:str, time_start:float):
+    '记录一次API请求的耗时'
+    api_seconds.observe(
+        time.monotonic() - time_start, service=service, host=get_server(url), api=get_api(url)
+        )
+
+def observe_upload(url_alist:str, size:int, time_start:float):
+    '记录一次成功的上传'
+    seconds = time.monotonic() - time_start
+    server = get_server(url_alist)
+    upload_bytes.inc(size, server=server)
+    upload_seconds.observe(seconds, server=server)
+    if seconds > 0:
+        upload_throughput.set(size / seconds, server=server)
+
+def get_sent_counter(url_alist:str):
+    '获取记录发送字节数的回调'
+    server = get_server(url_alist)
+    return lambda size: upload_sent_bytes.inc(size, server=server)
+
+def render():
+    '生成Prometheus文本格式的所有指标'
+    return "\n".join(metric.render() for metric in registry) + "\n"
@@ -0,0 +1,113 @@
+import math
+
+# Prometheus默认的直方图分桶(秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape_label(value):
+    '转义标签值'
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(labels:dict):
+    '生成{a="1",b="2"}格式的标签'
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape_label(v)}"' for k, v in labels.items()) + "}"
+
+def format_value(value:float):
+    '数值转成文本'
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    '指标基类，标签通过关键字参数传入'
+    kind = "untyped"
+    name: str
+    help_text: str
+    labelnames: tuple
+
+    def __init__(self, name:str, help_text:str, labelnames:tuple|list=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def get_key(self, labels:dict):
+        '标签 -> 键'
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[k]) for k in self.labelnames)
+
+    def clear(self):
+        '清空所有数据'
+        self._values.clear()
+
+    def collect(self):
+        '生成(样本名后缀, 标签, 数值)'
+        for key, value in self._values.items():
+            yield "", dict(zip(self.labelnames, key)), value
+
+    def render(self):
+        '生成Prometheus文本格式'
+        lines = [
+            f"# HELP {self.name} {self.help_text}",
+            f"# TYPE {self.name} {self.kind}",
+            ]
+        for suffix, labels, value in self.collect():
+            lines.append(f"{self.name}{suffix}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    '只增不减的计数器'
+    kind = "counter"
+
+    def inc(self, amount:float=1, **labels):
+        '增加'
+        key = self.get_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    '可以任意设置的数值'
+    kind = "gauge"
+
+    def set(self, value:float, **labels):
+        '设置'
+        self._values[self.get_key(labels)] = value
+
+
+class Histogram(Metric):
+    '直方图，记录分布'
+    kind = "histogram"
+    buckets: tuple
+
+    def __init__(self, name:str, help_text:str, labelnames:tuple|list=(), buckets:tuple=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value:float, **labels):
+        '记录一个值'
+        key = self.get_key(labels)
+        if key not in self._values:
+            # 每个分桶的计数, 总和, 总数
+            self._values[key] = [[0] * len(self.buckets), 0, 0]
+        counts, _, _ = data = self._values[key]
+        for idx, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[idx] += 1
+        data[1] += value
+        data[2] += 1
+
+    def collect(self):
+        for key, (counts, total, count) in self._values.items():
+            labels = dict(zip(self.labelnames, key))
+            for bound, bucket_count in zip(self.buckets, counts):
+                yield "_bucket", {**labels, 'le': format_value(bound)}, bucket_count
+            yield "_bucket", {**labels, 'le': "+Inf"}, count
+            yield "_sum", labels, total
+            yield "_count", labels, count
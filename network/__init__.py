@@ -0,0 +1,157 @@
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+from static import config, logger
+from .utils import TokenBucket, StreamHasher, read_file
+
+
+class SessionPool:
+    '按上游主机复用的长连接会话池'
+    __sessions: dict
+    __retired: list
+    __active: dict
+
+    def __init__(self):
+        self.__sessions = {}
+        self.__retired = []
+        # 会话 -> 正在进行的请求数
+        self.__active = {}
+
+    @staticmethod
+    def get_host(url:str):
+        '从url里取出协议和主机部分'
+        res = urlsplit(url)
+        return f"{res.scheme}://{res.netloc}"
+
+    def get_session(self, url:str):
+        '获取对应主机的会话，不存在就新建'
+        host = self.get_host(url)
+        session = self.__sessions.get(host)
+        if session is None or session.closed:
+            settings = config.network
+            connector = TCPConnector(
+                limit=settings['limit'],
+                limit_per_host=settings['limit_per_host'],
+                keepalive_timeout=settings['keepalive_timeout'],
+                ttl_dns_cache=settings['dns_cache_ttl'],
+                use_dns_cache=settings['dns_cache_ttl'] > 0,
+                )
+            session = ClientSession(connector=connector, timeout=ClientTimeout(total=None))
+            self.__sessions[host] = session
+            logger.debug(f"Session created for {host}")
+        return session
+
+    @asynccontextmanager
+    async def use(self, url:str):
+        '获取会话并记录正在使用，被renew()换下的旧会话在最后一个请求结束后关闭'
+        session = self.get_session(url)
+        self.__active[session] = self.__active.get(session, 0) + 1
+        try:
+            yield session
+        finally:
+            self.__active[session] -= 1
+            if not self.__active[session]:
+                del self.__active[session]
+                if session in self.__retired:
+                    self.__retired.remove(session)
+                    await session.close()
+                    logger.debug("Retired session closed")
+
+    async def renew(self):
+        '之后的请求按新的设置建立会话，旧会话没有请求的话直接关闭，有的话等请求结束后关闭'
+        sessions = list(self.__sessions.values())
+        self.__sessions.clear()
+        for session in sessions:
+            if session in self.__active:
+                self.__retired.append(session)
+            else:
+                await session.close()
+        logger.debug(f"Sessions renewed, {len(self.__retired)} old sessions still in use")
+
+    async def close(self):
+        '关闭所有会话'
+        for host, session in self.__sessions.items():
+            await session.close()
+            logger.debug(f"Session closed for {host}")
+        self.__sessions.clear()
+        for session in self.__retired:
+            await session.close()
+        self.__retired.clear()
+
+
+sessions = SessionPool()
+
+def get_session(url:str):
+    '获取共享会话'
+    return sessions.get_session(url)
+
+def use_session(url:str):
+    '获取共享会话并在用完之前记录为正在使用(async with)'
+    return sessions.use(url)
+
+# 限速器
+upload_limiter = TokenBucket()
+server_upload_limiters = {}
+server_api_limiters = {}
+
+def get_server_key(settings_alist:dict):
+    '区分不同备份服务器(同一alist下的不同存储分开算)'
+    return (settings_alist['url_alist'], settings_alist['remote_dir'])
+
+def get_server_settings(settings_alist:dict):
+    '从当前配置里找到对应的服务器设置，运行中重新加载过配置的话以新配置为准'
+    key = get_server_key(settings_alist)
+    for settings_temp in [config.alist, *config.autobackup['servers']]:
+        if settings_temp.get('url_alist') and get_server_key(settings_temp) == key:
+            return settings_temp
+    return settings_alist
+
+def get_upload_limiters(settings_alist:dict):
+    '获取上传要经过的限速器(全局+服务器)'
+    upload_limiter.set_rate(config.network['upload_limit'] * 1024)
+    settings_temp = get_server_settings(settings_alist)
+    key = get_server_key(settings_alist)
+    limiter = server_upload_limiters.setdefault(key, TokenBucket())
+    limiter.set_rate(settings_temp.get('upload_limit', 0) * 1024)
+    return [upload_limiter, limiter]
+
+def get_api_limiter(settings_alist:dict):
+    '获取API请求频率限制器'
+    settings_temp = get_server_settings(settings_alist)
+    key = get_server_key(settings_alist)
+    limiter = server_api_limiters.setdefault(key, TokenBucket())
+    limiter.set_rate(settings_temp.get('api_rate', 0))
+    return limiter
+
+def apply_settings():
+    '把当前配置应用到已有的限速器上(正在进行的上传也会生效)'
+    upload_limiter.set_rate(config.network['upload_limit'] * 1024)
+    for settings_temp in [config.alist, *config.autobackup['servers']]:
+        if not settings_temp.get('url_alist'):
+            continue
+        key = get_server_key(settings_temp)
+        if key in server_upload_limiters:
+            server_upload_limiters[key].set_rate(settings_temp.get('upload_limit', 0) * 1024)
+        if key in server_api_limiters:
+            server_api_limiters[key].set_rate(settings_temp.get('api_rate', 0))
+    logger.debug("Rate limits updated")
+
+async def init():
+    '初始化'
+    # 预先为已配置的主机建好会话
+    urls = [config.blrec['url_blrec']]
+    if config.alist['enabled']:
+        urls.append(config.alist['url_alist'])
+    for settings_alist in config.autobackup['servers']:
+        if settings_alist['enabled']:
+            urls.append(settings_alist['url_alist'])
+    for url in urls:
+        sessions.get_session(url)
+    logger.debug("Session pool started")
+    return sessions
+
+async def close():
+    '关闭所有会话'
+    await sessions.close()
@@ -0,0 +1,124 @@
+import asyncio, collections, hashlib, itertools, os, time
+
+from contextlib import aclosing
+
+
+class TokenBucket:
+    '令牌桶限速器，rate<=0时不限速'
+    rate: float
+    capacity: float
+
+    def __init__(self, rate:float=0, capacity:float=0):
+        self.__lock = asyncio.Lock()
+        self.__tokens = 0
+        self.__last = time.monotonic()
+        self.set_rate(rate, capacity)
+
+    def set_rate(self, rate:float, capacity:float=0):
+        '修改速率，capacity默认为1秒的量'
+        self.rate = rate
+        self.capacity = capacity if capacity > 0 else rate
+        self.__tokens = min(self.__tokens, self.capacity)
+
+    async def consume(self, amount:float=1):
+        '取走令牌，不够的话等到够为止'
+        if self.rate <= 0:
+            return
+        async with self.__lock:
+            time_now = time.monotonic()
+            self.__tokens = min(self.capacity, self.__tokens + (time_now - self.__last) * self.rate)
+            self.__last = time_now
+            self.__tokens -= amount
+            if self.__tokens < 0:
+                # 按顺序排队等待，等待期间补充的令牌下次取用时计算
+                await asyncio.sleep(-self.__tokens / self.rate)
+
+
+class StreamHasher:
+    '边读边算哈希，每次重新读取文件前重置；file_size和mtime是开始计算时文件的状态'
+    hash_types: list
+    size: int
+    file_size: int
+    mtime: float
+
+    def __init__(self, hash_types:list, file_size:int=0, mtime:float=0):
+        self.hash_types = hash_types
+        self.file_size = file_size
+        self.mtime = mtime
+        self.reset()
+
+    @property
+    def is_complete(self):
+        '是否完整读完了文件'
+        return self.size == self.file_size
+
+    def reset(self):
+        '重置'
+        self.__hashes = {name: hashlib.new(name) for name in self.hash_types}
+        self.size = 0
+
+    def update(self, chunk:bytes):
+        '加入一块数据'
+        for h in self.__hashes.values():
+            h.update(chunk)
+        self.size += len(chunk)
+
+    def hexdigest(self):
+        '返回{哈希类型: 十六进制哈希}'
+        return {name: h.hexdigest() for name, h in self.__hashes.items()}
+
+
+async def iter_chunks(f, chunk_size:int, read_ahead:int=0):
+    '''
+    按顺序读取文件块，read_ahead>0时在线程池里用pread提前读好后面几块，磁盘慢的时候不会卡住事件循环
+    (aiohttp的客户端不支持sendfile，而且每块数据都要经过限速、计数和哈希，所以不用零拷贝)
+    '''
+    if read_ahead <= 0 or not hasattr(os, 'pread'):
+        while chunk := f.read(chunk_size):
+            yield chunk
+        return
+
+    loop = asyncio.get_running_loop()
+    fd = f.fileno()
+    offsets = iter(range(0, os.fstat(fd).st_size, chunk_size))
+    pending = collections.deque(
+        loop.run_in_executor(None, os.pread, fd, chunk_size, offset)
+        for offset in itertools.islice(offsets, read_ahead)
+        )
+    try:
+        while pending:
+            chunk = await pending.popleft()
+            offset = next(offsets, None)
+            if offset is not None:
+                pending.append(loop.run_in_executor(None, os.pread, fd, chunk_size, offset))
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        # 提前结束的话，等线程里的读取结束再关闭文件
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+async def read_file(filename:str, chunk_size:int, limiters:list=[], counter=None,
+                    hasher:StreamHasher|None=None, read_ahead:int=0):
+    '''
+    分块读取文件，每块都经过限速器
+    counter: 统计发送字节数的回调
+    hasher: 顺便计算哈希(read_ahead>0时也在线程池里算)
+    read_ahead: 在线程池里提前读取的块数，0表示直接在事件循环里读
+    '''
+    if hasher:
+        hasher.reset()
+    loop = asyncio.get_running_loop()
+    with open(filename, 'rb') as f:
+        async with aclosing(iter_chunks(f, chunk_size, read_ahead)) as chunks:
+            async for chunk in chunks:
+                for limiter in limiters:
+                    await limiter.consume(len(chunk))
+                if counter:
+                    counter(len(chunk))
+                if hasher and read_ahead > 0:
+                    await loop.run_in_executor(None, hasher.update, chunk)
+                elif hasher:
+                    hasher.update(chunk)
+                yield chunk
@@ -1,6 +1,7 @@
-import json, os, uvicorn, traceback
+import json, uvicorn, traceback, time, datetime, asyncio
 
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from uuid import UUID
@@ -10,14 +11,21 @@ from contextlib import asynccontextmanager
 import alist
 import blrec
 import db
+import metrics
+import network
+import upload_queue
 
-from static import config, logger, Config, App
+import static
+from static import config, config_cache, logger, App
+from static.utils import FileWatcher, get_diff
 
 import cookies_checker
 from cookies_checker.utils import refresh_cookies
 
+from db.utils import check_event, forget_event
+
 import autobackup
-from autobackup.utils import show_status, change_status, del_task, dump_task, load_task, retry_task
+from autobackup.utils import get_status, count_status, change_status, del_task, dump_task, load_task, retry_task
 
 
 class BlrecWebhookData(BaseModel):
@@ -28,18 +36,75 @@ class BlrecWebhookData(BaseModel):
     data: dict
 
 
+# 连接池相关的设置，改了要重建会话
+SESSION_KEYS = ('limit', 'limit_per_host', 'keepalive_timeout', 'dns_cache_ttl')
+reload_lock = asyncio.Lock()
+
+async def apply_config(filename:str="settings.toml"):
+    '重新加载配置，只应用有变化的部分(正在进行的上传不受影响)，返回{分区: [有变化的键]}'
+    # 文件监视和手动重载可能同时触发，一次只应用一个
+    async with reload_lock:
+        # 先完整解析一遍，出错的话保持原来的配置
+        settings_new = config_cache.get(filename)
+        settings_old = config.to_dict()
+        config.copy_from(settings_new)
+        diff = get_diff(settings_old, config.to_dict())
+        if not diff:
+            logger.info(f"Config {filename} reloaded, nothing changed.")
+            return diff
+        logger.info(f"Config {filename} reloaded, changed: {diff}")
+
+        if 'log' in diff:
+            static.init_logger()
+        if {'network', 'alist', 'autobackup'} & diff.keys():
+            network.apply_settings()
+            alist.apply_settings()
+        if set(SESSION_KEYS) & set(diff.get('network', [])):
+            await network.sessions.renew()
+        if 'blrec' in diff:
+            blrec.room_cache.apply_settings()
+        if 'queue' in diff:
+            upload_queue.pool.resize(config.queue['workers'])
+        if 'cookies' in diff:
+            cookies_checker.reschedule()
+        if 'autobackup' in diff:
+            await db.sync_servers(config.autobackup)
+            await autobackup.reschedule()
+        if 'config_watch_interval' in diff.get('server', []):
+            config_watcher.interval = config.app['config_watch_interval']
+            if config_watcher.interval > 0:
+                config_watcher.start()
+            else:
+                config_watcher.stop()
+        if 'db' in diff or {'host_server', 'port_server'} & set(diff.get('server', [])):
+            logger.warning("Database or listening address changed, restart to apply.")
+        return diff
+
+config_watcher = FileWatcher(config.path, apply_config)
+
 @asynccontextmanager
 async def lifespan(_app):
     '生命周期管理'
-    # config.load()
     await db.init_db()
+    await network.init()
     cookies_scheduler = await cookies_checker.init()
     autobackup_scheduler = await autobackup.init()
+    upload_pool = await upload_queue.init()
+    # 配置文件改了自动重新加载
+    config_watcher.interval = config.app['config_watch_interval']
+    config_watcher.watch(config.path)
+    config_watcher.start()
 
     yield
 
+    config_watcher.stop()
+    await upload_pool.shutdown()
     cookies_scheduler.shutdown()
     autobackup_scheduler.shutdown()
+    # 还在用数据库和会话的后台任务要在关闭前停下
+    await autobackup.close()
+    await alist.removal_queue.close()
+    await network.close()
     await db.close()
 
 app = FastAPI(lifespan=lifespan)
@@ -70,19 +135,35 @@ async def get_version(package:str=""):
 
 @app.post('/settings/reload')
 async def reload_settings(filename:str="settings.toml"):
-    '重新加载设置'
-    config.load(config_path=filename)
+    '重新加载设置，之后监视新的配置文件'
+    diff = await apply_config(filename)
+    config_watcher.watch(filename)
     return  {
         "code": 200,
-        "data": None
+        "data": diff
         }
 
 
+### 监控
+@app.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    'Prometheus格式的监控指标'
+    # 队列深度在抓取时现查
+    metrics.backup_tasks.clear()
+    for status, count in {'waiting': 0, 'uploading': 0, **await count_status()}.items():
+        metrics.backup_tasks.set(count, status=status)
+    metrics.upload_jobs.clear()
+    for status, count in {'waiting': 0, 'running': 0, **await upload_queue.count_jobs()}.items():
+        metrics.upload_jobs.set(count, status=status)
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
 ### 自动备份
 @app.get('/autobackup')
-async def get_backup_status():
-    '获取自动备份工作状态'
-    data = await show_status()
+async def get_backup_status(status:str="", server:int=0, cursor:int=0, limit:int=50):
+    '分页获取自动备份工作状态，next_cursor为None时说明已经是最后一页'
+    limit = max(1, min(limit, 500))
+    data = await get_status(status=status, server_id=server, cursor=cursor, limit=limit)
     return  {
         "code": 200,
         "data": data
@@ -92,7 +173,7 @@ async def get_backup_status():
 async def add_backup_task(local_dir:str, config_toml:str, now:bool=False):
     '添加备份任务'
     # 获取数据
-    settings_temp = Config(config_path=config_toml)
+    settings_temp = config_cache.get(config_toml)
     # 添加
     await autobackup.add_autobackup(
         # task_list=backup_job_list,
@@ -101,7 +182,7 @@ async def add_backup_task(local_dir:str, config_toml:str, now:bool=False):
         now=now
         )
     # 回复
-    data = await show_status()
+    data = await count_status()
     return  {
         "code": 200,
         "data": data
@@ -112,7 +193,7 @@ async def dump_backup_task(filename:str="task_backup.json"):
     '导出备份任务到文件'
     await dump_task(filename)
     # 回复
-    data = await show_status()
+    data = await count_status()
     return  {
         "code": 200,
         "data": data
@@ -123,7 +204,7 @@ async def load_backup_task(filename:str="task_backup.json"):
     '从文件中加载任务信息'
     await load_task(filename)
     # 回复
-    data = await show_status()
+    data = await count_status()
     return  {
         "code": 200,
         "data": data
@@ -148,6 +229,28 @@ async def retry_backup_task(id:int=-1, all:bool=False):
         }
 
 
+### 上传队列
+@app.get('/queue')
+async def get_queue_status():
+    '获取上传队列各状态的任务数量和失败的任务'
+    return {
+        "code": 200,
+        "data": {
+            'counts': await upload_queue.count_jobs(),
+            'failed': await upload_queue.get_failed_jobs(),
+            }
+        }
+
+@app.post('/queue/retry')
+async def retry_queue_job(id:int=-1, all:bool=False):
+    '重试失败的上传队列任务'
+    data = await upload_queue.retry_jobs(id=id, retry_all=all)
+    return  {
+        "code": 200,
+        "data": data
+        }
+
+
 ### 手动上传接口
 # @app.post('/upload')
 # async def manual_upload(path: str):
@@ -155,6 +258,41 @@ async def retry_backup_task(id:int=-1, all:bool=False):
 
 
 ### BLREC Webhook
+async def handle_event(json_obj:dict):
+    '处理一个webhook事件，返回"processed"或者重复事件的"duplicate"'
+    event_id = json_obj['id']
+    event_type = json_obj['type']
+    # blrec没收到回复时会重发同一个事件
+    if not await check_event(event_id, event_type):
+        logger.info(f"Skipping duplicate {event_type} {event_id}")
+        return "duplicate"
+    time_start = time.monotonic()
+    try:
+        # 先根据事件更新缓存的直播间信息，后面的查询才是最新的
+        blrec.room_cache.handle_event(event_type, json_obj['data'])
+        # 根据接收到的blrec webhook参数执行相应操作
+        if event_type == 'RecordingFinishedEvent':
+            # 录制完成，如果没有其他在录制的任务的话就更新一下cookies
+            if not await blrec.get_blrec_data(select='recording'):
+                await refresh_cookies(silent=True)
+        elif event_type == 'VideoPostprocessingCompletedEvent':
+            # 视频后处理完成，加入上传队列(上传+自动备份)，不在这里等待上传
+            # 自动备份的时间按收到事件的时间算，上传重试多少次都不变
+            payload = {
+                'room_id': json_obj['data']['room_id'],
+                'path': json_obj['data']['path'],
+                'time': datetime.datetime.now(tz=datetime.timezone.utc).isoformat(),
+                }
+            await upload_queue.enqueue('postprocessed', payload, url=config.alist['url_alist'])
+        else:
+            logger.info(f"Got unknown Event: {event_type}")
+    except Exception:
+        # 处理失败的话允许重发的事件再处理一次
+        await forget_event(event_id)
+        raise
+    metrics.webhook_seconds.observe(time.monotonic() - time_start, type=event_type)
+    return "processed"
+
 @app.post('/blrec')
 async def blrec_webhook(data: BlrecWebhookData|str):
     '接收webhook信息'
@@ -164,41 +302,34 @@ async def blrec_webhook(data: BlrecWebhookData|str):
         json_obj = data.dict()
     else:
         raise
-    event_type = json_obj['type']
-    # 根据接收到的blrec webhook参数执行相应操作
-    # 更新：不用套try语句，要是出错http模块会自己处理
-    if event_type == 'RecordingFinishedEvent':
-        # 录制完成，如果没有其他在录制的任务的话就更新一下cookies
-        if not await blrec.get_blrec_data(select='recording'):
-            await refresh_cookies(silent=True)
-    elif event_type == 'VideoPostprocessingCompletedEvent':
-        # 视频后处理完成，上传+自动备份
-        # 获取直播间信息
-        room_id = json_obj['data']['room_id']
-        room_info = await blrec.get_blrec_data(room_id)
-        # 上传
-        filename = json_obj['data']['path']
-        try:
-            await alist.upload_video(filename, rec_info=room_info, settings_alist=config.alist)
-        except Exception as e:
-            logger.error(e)
-        # 自动备份
-        local_dir = os.path.split(filename)[0]
-        await autobackup.add_autobackup(
-            # task_list = backup_job_list,
-            settings_autobackup = config.autobackup, 
-            local_dir = local_dir)
-    else:
-        logger.info("Got unknown Event: ", event_type)
+    # 不用套try语句，要是出错http模块会自己处理
+    status = await handle_event(json_obj)
     # 回复
     return  {
         "code": 200,
-        "message": "Mua!"
+        "message": "Mua!" if status == "processed" else "Duplicate"
+        }
+
+@app.post('/blrec/batch')
+async def blrec_webhook_batch(events: list[BlrecWebhookData]):
+    '按顺序处理一批webhook事件(例如重放积压的事件)，返回每个事件的处理结果'
+    data = []
+    for event in events:
+        json_obj = event.dict()
+        try:
+            status = await handle_event(json_obj)
+        except Exception:
+            logger.error(f"Failed to handle {json_obj['type']} {json_obj['id']}: {traceback.format_exc()}")
+            status = "error"
+        data.append({'id': json_obj['id'], 'type': json_obj['type'], 'status': status})
+    return {
+        "code": 200,
+        "data": data
         }
 
 
 if __name__ == "__main__":
-    # static.init()
+    static.init()
     logger.info("Autorec service started.")
     uvicorn.run(
         app=app, 
@@ -1,7 +1,10 @@
-import sys, toml
+import copy, os, sys, toml
+from collections import OrderedDict
 from importlib.metadata import version
 from loguru import logger
 
+from .utils import get_template
+
 class App:
     'autorec的自身信息'
 
@@ -22,49 +25,114 @@ class Config:
     __autobackup:dict
     __cookies:dict
     __db:dict
+    __network:dict
+    __queue:dict
+    path: str
+    is_loaded: bool
+
+    def __init__(self, config_path="settings.toml", lazy=False):
+        '''
+        lazy: 不立即读取配置文件，第一次用到配置时再读取
+        '''
+        self.path = config_path
+        self.is_loaded = False
+        if not lazy:
+            self.load(config_path)
+
+    def __ensure_loaded(self):
+        '还没读取过配置文件的话先读取'
+        if not self.is_loaded:
+            self.load(self.path)
 
-    def __init__(self, config_path="settings.toml"):
-        self.load(config_path)
+    def to_dict(self):
+        '按配置文件里的分区返回所有设置'
+        self.__ensure_loaded()
+        return {
+            'server': self.__app,
+            'log': self.__log,
+            'alist': self.__alist,
+            'blrec': self.__blrec,
+            'autobackup': self.__autobackup,
+            'cookies': self.__cookies,
+            'db': self.__db,
+            'network': self.__network,
+            'queue': self.__queue,
+            }
+
+    def copy_from(self, other:'Config'):
+        '换成另一份已经读取好的配置(深拷贝，之后各改各的)'
+        data = copy.deepcopy(other.to_dict())
+        self.__app = data['server']
+        self.__log = data['log']
+        self.__alist = data['alist']
+        self.__blrec = data['blrec']
+        self.__autobackup = data['autobackup']
+        self.__cookies = data['cookies']
+        self.__db = data['db']
+        self.__network = data['network']
+        self.__queue = data['queue']
+        self.path = other.path
+        self.is_loaded = True
 
     @property
     def app(self):
         'api设置'
+        self.__ensure_loaded()
         return self.__app
 
     @property
     def cookies(self):
         'cookies设置'
+        self.__ensure_loaded()
         return self.__cookies
 
     @property
     def autobackup(self):
         '自动备份设置'
+        self.__ensure_loaded()
         return self.__autobackup
 
     @property
     def blrec(self):
         'blrec设置'
+        self.__ensure_loaded()
         return self.__blrec
 
     @property
     def alist(self):
         'alist设置'
+        self.__ensure_loaded()
         return self.__alist
 
     @property
     def db(self):
         '数据库设置'
+        self.__ensure_loaded()
         return self.__db
 
+    @property
+    def network(self):
+        '网络连接设置'
+        self.__ensure_loaded()
+        return self.__network
+
+    @property
+    def queue(self):
+        '上传队列设置'
+        self.__ensure_loaded()
+        return self.__queue
+
     @property
     def log(self):
         '日志记录器'
+        self.__ensure_loaded()
         return self.__log
 
     def write_default(self):
         '写入默认配置'
         self.DEFAULT_SETTINGS = r"""[blrec]
 url_blrec = 'http://localhost:2233'
+cache_ttl = 30 # optional, in seconds, how long room data fetched from blrec is reused (also updated by webhook events), 0 to disable
 
 [alist]
 enabled = true # optional, true for default
@@ -76,14 +144,20 @@ remote_dir = '/quark/2024_下/{time/%y%m%d}_{room_info/title}'
 # usage: {time/<time formatting expressions>} or {<keys of recording properties>/<attribute>}
 # (Refer to README.md)
 remove_after_upload = false # optional, whether delete local file after upload, false by default
+upload_limit = 0 # optional, in KiB/s, upload speed limit for this server, 0 for unlimited
+api_rate = 0 # optional, max API requests per second to this server (useful for quark/baidu drivers), 0 for unlimited
 
 [cookies]
 check_interval = 43200 # optional, in seconds
 
 [autobackup]
 # Settings for auto backup
-check_interval = 60 # optional, in seconds
 auto_remove = true # optional, whether remove task when completed, true in default
+fanout = false # optional, read each file once and upload it to all servers due at the same time, false in default
+max_tasks = 4 # optional, max backup tasks running at the same time
+max_tasks_per_server = 1 # optional, max backup tasks running at the same time for the same backup server (storages under one alist are counted separately)
+max_files = 2 # optional, max files uploaded at the same time in one task
+batch_size = 100 # optional, max due tasks fetched from the database at a time
 [[autobackup.servers]]
 # Support multiple remote configs, the same format as 'alist' part above
 # For example, when remote_dir is set to /xxx, it would seem like:
@@ -95,11 +169,47 @@ username = 'username'
 password = 'SHA-256'
 remote_dir = '/remote/records/'
 remove_after_upload = false
+upload_limit = 0
+api_rate = 0
 
 [server]
 host_server = 'localhost'
 port_server = 23560
-max_retries = 6
+max_retries = 6 # optional, max attempts of each request to alist
+retry_interval = 1 # optional, in seconds, wait before the first retry
+retry_backoff = 4 # optional, the wait is multiplied by this after each retry
+retry_max_interval = 600 # optional, in seconds, upper limit of the wait
+retry_jitter = 0 # optional, 0~1, randomize each wait by this fraction to spread out retries from many uploads
+webhook_dedupe_size = 1024 # optional, recent webhook event ids kept in memory to skip events resent by blrec
+webhook_dedupe_days = 7 # optional, how long received webhook event ids are kept in the database
+config_watch_interval = 5 # optional, in seconds, check settings.toml for changes and apply them without restarting, 0 to disable
+
+[queue]
+# optional, settings of the upload job queue behind the blrec webhook
+workers = 4 # max jobs running at the same time
+per_host = 2 # max jobs running at the same time for the same alist server
+max_attempts = 5 # a job is marked failed after so many attempts
+retry_interval = 60 # in seconds, doubled after each failed attempt
+poll_interval = 30 # in seconds, how often idle workers check the queue for due jobs (new jobs wake them up at once)
+coalesce_window = 60 # in seconds, auto backup of a recording folder is added once this long after its last segment finished
+
+[network]
+# optional, settings of the shared connection pools to alist and blrec
+limit = 100 # max connections in total for each host's pool
+limit_per_host = 10 # max connections to the same host
+keepalive_timeout = 60 # in seconds, how long an idle connection is kept alive
+dns_cache_ttl = 300 # in seconds, 0 to disable dns cache
+token_ttl = 86400 # in seconds, how long an alist token is reused before logging in again
+upload_limit = 0 # in KiB/s, total upload speed limit of all servers, 0 for unlimited
+chunk_size = 256 # in KiB, size of each block read from the file when uploading
+read_ahead = 4 # blocks read ahead in a thread pool while uploading so slow disks don't block the server, 0 to read in the event loop
+list_page_size = 200 # number of files fetched per request when listing a remote directory
+list_cache_ttl = 600 # in seconds, how long a remote directory listing is reused
+list_cache_size = 256 # max remote directory listings kept in memory
+fanout_buffer = 4 # blocks buffered for each server in fan-out mode, the slowest server holds back the reading
+hash_types = ['md5', 'sha1'] # hashes computed while uploading and compared with alist's hash_info, [] to compare sizes only
+verify_interval = 30 # in seconds, with remove_after_upload, local files are removed only after the remote copies are confirmed by a fresh listing
+verify_attempts = 20 # give up and keep the local file if the remote copy is still not confirmed after so many checks
 
 [db]
 # database settings, currently supports postgres only
@@ -108,6 +218,7 @@ pg_port = '5432'
 pg_user = 'postgres'
 pg_password = 'pg_password'
 pg_database = 'autorec'
+# url = 'sqlite://autorec.sqlite3' # optional, full database url overriding the settings above (e.g. sqlite for benchmarks)
 
 [log]
 file = "logs.log" # Leave empty to disable logging to file
@@ -130,39 +241,120 @@ level = "INFO"
             self.__alist = config_file.get('alist', {})
             self.__log = config_file.get('log', {})
             self.__db = config_file.get('db', {})
+            self.__network = config_file.get('network', {})
+            self.__queue = config_file.get('queue', {})
 
         # 设置默认值
         self.__app.setdefault('max_retries', 6)
+        self.__app.setdefault('retry_interval', 1)
+        self.__app.setdefault('retry_backoff', 4)
+        self.__app.setdefault('retry_max_interval', 600)
+        self.__app.setdefault('retry_jitter', 0)
+        self.__app.setdefault('webhook_dedupe_size', 1024)
+        self.__app.setdefault('webhook_dedupe_days', 7)
+        self.__app.setdefault('config_watch_interval', 5)
 
         self.__log.setdefault('file', '')
 
+        self.__blrec.setdefault('cache_ttl', 30)
+
         self.__alist.setdefault('remove_after_upload', False)
         self.__alist.setdefault('enabled', True)
+        self.__alist.setdefault('upload_limit', 0)
+        self.__alist.setdefault('api_rate', 0)
 
-        self.__autobackup.setdefault('interval', 60)
         self.__autobackup.setdefault('auto_remove', True)
+        self.__autobackup.setdefault('fanout', False)
+        self.__autobackup.setdefault('max_tasks', 4)
+        self.__autobackup.setdefault('max_tasks_per_server', 1)
+        self.__autobackup.setdefault('max_files', 2)
+        self.__autobackup.setdefault('batch_size', 100)
         # self.settings_autobackup.setdefault('retry_times', 6)
         self.__autobackup.setdefault('servers', [])
         for i in self.__autobackup['servers']:
             i.setdefault('remove_after_upload', False)
             i.setdefault('enabled', True)
+            i.setdefault('upload_limit', 0)
+            i.setdefault('api_rate', 0)
         
         self.__cookies.setdefault('check_interval', 43200)
 
+        self.__queue.setdefault('workers', 4)
+        self.__queue.setdefault('per_host', 2)
+        self.__queue.setdefault('max_attempts', 5)
+        self.__queue.setdefault('retry_interval', 60)
+        self.__queue.setdefault('poll_interval', 30)
+        self.__queue.setdefault('coalesce_window', 60)
+
+        self.__network.setdefault('limit', 100)
+        self.__network.setdefault('limit_per_host', 10)
+        self.__network.setdefault('keepalive_timeout', 60)
+        self.__network.setdefault('dns_cache_ttl', 300)
+        self.__network.setdefault('token_ttl', 86400)
+        self.__network.setdefault('upload_limit', 0)
+        self.__network.setdefault('chunk_size', 256)
+        self.__network.setdefault('read_ahead', 4)
+        self.__network.setdefault('fanout_buffer', 4)
+        self.__network.setdefault('list_page_size', 200)
+        self.__network.setdefault('list_cache_ttl', 600)
+        self.__network.setdefault('list_cache_size', 256)
+        self.__network.setdefault('hash_types', ['md5', 'sha1'])
+        self.__network.setdefault('verify_interval', 30)
+        self.__network.setdefault('verify_attempts', 20)
+
+        # 预先解析上传路径模板，写错的话加载时就报错
+        if 'remote_dir' in self.__alist:
+            get_template(self.__alist['remote_dir'])
+
+        self.path = config_path
+        self.is_loaded = True
+
 
-# 初始化配置
-config = Config()
-config.load()
+class ConfigCache:
+    '按(路径, 修改时间, 大小)缓存读取好的配置文件，文件改了才重新解析'
+    maxsize: int
+
+    def __init__(self, maxsize:int=16):
+        self.maxsize = maxsize
+        self.__data = OrderedDict()
+
+    def get(self, config_path:str):
+        '获取配置，返回的Config是共用的，不要修改'
+        stat = os.stat(config_path)
+        path = os.path.abspath(config_path)
+        item = self.__data.get(path)
+        if item is not None and item[0] == (stat.st_mtime_ns, stat.st_size):
+            self.__data.move_to_end(path)
+            return item[1]
+        settings = Config(config_path)
+        self.__data[path] = ((stat.st_mtime_ns, stat.st_size), settings)
+        self.__data.move_to_end(path)
+        while len(self.__data) > self.maxsize:
+            self.__data.popitem(last=False)
+        return settings
+
+
+# 全局配置，在init()或者第一次用到时读取
+config = Config(lazy=True)
+config_cache = ConfigCache()
 
 # 初始化自动备份服务器
 backup_job_list = []
 
-# 初始化日志
-log_file = config.log['file']
-level = config.log['level']
-logger.remove()
-if log_file:
-    logger.add(log_file, enqueue=True, level=level)
-    logger.add(sys.stdout, enqueue=True, level="INFO")
-else:
-    logger.add(sys.stdout, enqueue=True, level=level)
+def init_logger():
+    '按配置设置日志'
+    log_file = config.log['file']
+    level = config.log['level']
+    logger.remove()
+    if log_file:
+        logger.add(log_file, enqueue=True, level=level)
+        logger.add(sys.stdout, enqueue=True, level="INFO")
+    else:
+        logger.add(sys.stdout, enqueue=True, level=level)
+
+def init(config_path="settings.toml"):
+    '读取配置并设置日志，在程序入口调用'
+    if not config.is_loaded or config.path != config_path:
+        config.load(config_path)
+    init_logger()
+    return config
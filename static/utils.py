@@ -0,0 +1,170 @@
+import asyncio, datetime, os, re, time, traceback
+from collections import OrderedDict
+from functools import lru_cache, reduce
+from loguru import logger
+
+
+class TTLCache:
+    '带过期时间和容量上限的LRU缓存'
+    ttl: float
+    maxsize: int
+
+    def __init__(self, ttl:float, maxsize:int):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.__data = OrderedDict()
+
+    def get(self, key, default=None):
+        '读取，过期的话当作不存在'
+        item = self.__data.get(key)
+        if item is None:
+            return default
+        value, expire_time = item
+        if time.monotonic() >= expire_time:
+            del self.__data[key]
+            return default
+        self.__data.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        '写入，超出容量时淘汰最久没用过的'
+        self.__data[key] = (value, time.monotonic() + self.ttl)
+        self.__data.move_to_end(key)
+        while len(self.__data) > self.maxsize:
+            self.__data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        '删除'
+        item = self.__data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        '清空'
+        self.__data.clear()
+
+    def keys(self):
+        '所有键(包括已过期但还没清理的)'
+        return list(self.__data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self.__data)
+
+
+class MacroTemplate:
+    '''
+    预先解析好的上传路径模板，例如'/rec/{time/%y%m%d}_{room_info/title}'
+    {time/<时间格式>}替换成当前时间，{room_info|user_info|task_status/<属性>/...}替换成录制信息里的值
+    '''
+    PATTERN = re.compile(r'{([^}/]*)/([^}]*)}')
+    ROOTS = ('time', 'room_info', 'user_info', 'task_status')
+    template: str
+
+    def __init__(self, template:str):
+        self.template = template
+        # 普通字符串或(根, 时间格式/属性路径)
+        self.__parts = []
+        pos = 0
+        for match in self.PATTERN.finditer(template):
+            root, path = match.groups()
+            if root not in self.ROOTS:
+                raise ValueError(f"Unknown macro {match.group(0)} in {template!r}, should start with one of {self.ROOTS}")
+            keys = path if root == 'time' else path.split('/')
+            if not path or not all(keys):
+                raise ValueError(f"Empty key in macro {match.group(0)} in {template!r}")
+            self.__parts.append(template[pos:match.start()])
+            self.__parts.append((root, keys))
+            pos = match.end()
+        self.__parts.append(template[pos:])
+        self.__parts = [part for part in self.__parts if part]
+
+    @property
+    def is_static(self):
+        '是否不含宏'
+        return all(isinstance(part, str) for part in self.__parts)
+
+    def render(self, data:dict, time_now:datetime.datetime|None=None):
+        '填充模板，time_now默认为当前时间'
+        time_now = time_now or datetime.datetime.now()
+        res = []
+        for part in self.__parts:
+            if isinstance(part, str):
+                res.append(part)
+            elif part[0] == 'time':
+                res.append(time_now.strftime(part[1]))
+            else:
+                res.append(str(reduce(lambda x,y:x[y], part[1], data[part[0]])))
+        return "".join(res)
+
+
+@lru_cache(maxsize=64)
+def get_template(template:str):
+    '获取编译好的模板(同一个模板只解析一次)'
+    return MacroTemplate(template)
+
+
+def get_diff(old:dict, new:dict):
+    '比较两份按分区划分的设置，返回{分区: [有变化的键]}'
+    diff = {}
+    for section in old.keys() | new.keys():
+        settings_old, settings_new = old.get(section, {}), new.get(section, {})
+        keys = sorted(
+            key for key in settings_old.keys() | settings_new.keys()
+            if settings_old.get(key) != settings_new.get(key)
+            )
+        if keys:
+            diff[section] = keys
+    return diff
+
+
+class FileWatcher:
+    '定时检查文件的修改时间，变了就调用回调(异步函数，参数是文件路径)'
+    path: str
+    interval: float
+
+    def __init__(self, path:str, callback, interval:float=5):
+        self.path = path
+        self.interval = interval
+        self.__callback = callback
+        self.__task = None
+        self.__stat = self.get_stat()
+
+    def get_stat(self):
+        '文件的(修改时间, 大小)，文件不存在时返回None'
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def watch(self, path:str):
+        '改成监视另一个文件(当前内容视为已经应用过)'
+        self.path = path
+        self.__stat = self.get_stat()
+
+    async def __run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            stat = self.get_stat()
+            if stat is None or stat == self.__stat:
+                continue
+            self.__stat = stat
+            try:
+                await self.__callback(self.path)
+            except Exception:
+                # 改到一半的文件可能解析失败，下次修改时再试
+                logger.error(f"Failed to apply changes of {self.path}: {traceback.format_exc()}")
+
+    def start(self):
+        '开始监视'
+        if self.__task is None and self.interval > 0:
+            self.__task = asyncio.create_task(self.__run())
+        return self
+
+    def stop(self):
+        '停止监视'
+        if self.__task is not None:
+            self.__task.cancel()
+            self.__task = None
@@ -0,0 +1,192 @@
+import asyncio, datetime, traceback
+
+from loguru import logger
+from tortoise.functions import Count
+
+import network
+from static import config
+from db.models import UploadJob
+
+from .utils import handlers
+
+
+class WorkerPool:
+    '上传任务的工作池'
+    __tasks: list
+    __retiring: set
+    __running: dict
+
+    def __init__(self):
+        self.__tasks = []
+        self.__retiring = set()
+        self.__running = {}
+        self.__count = 0
+        self.__event = asyncio.Event()
+        self.__claim_lock = asyncio.Lock()
+
+    def start(self, workers:int):
+        '启动工作协程'
+        self.resize(workers)
+
+    def resize(self, workers:int):
+        '调整工作协程数量，多出来的协程做完手上的任务再退出'
+        while len(self.__tasks) < workers:
+            self.__tasks.append(asyncio.create_task(self.__work(self.__count)))
+            self.__count += 1
+        while len(self.__tasks) > workers:
+            self.__retiring.add(self.__tasks.pop())
+        # 唤醒空闲的协程，该退出的退出
+        self.__event.set()
+
+    def notify(self):
+        '有新任务时唤醒空闲的工作协程'
+        self.__event.set()
+
+    async def shutdown(self):
+        '停止所有工作协程并等它们退出(之后才能关数据库)，未完成的任务下次启动时继续'
+        tasks = [*self.__tasks, *self.__retiring]
+        for task in tasks:
+            task.cancel()
+        self.__tasks.clear()
+        self.__retiring.clear()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def __claim(self):
+        '领取一个到期的任务，同一主机的并发数达到上限时跳过'
+        async with self.__claim_lock:
+            per_host = config.queue['per_host']
+            busy_hosts = [host for host, count in self.__running.items() if count >= per_host]
+            datetime_now = datetime.datetime.now(tz=datetime.timezone.utc)
+            query = UploadJob.filter(status='waiting', next_time__lte=datetime_now)
+            if busy_hosts:
+                query = query.filter(host__not_in=busy_hosts)
+            job = await query.order_by('next_time').first()
+            if job is None:
+                return None
+            await UploadJob.filter(id=job.id).update(status='running')
+            self.__running[job.host] = self.__running.get(job.host, 0) + 1
+            return job
+
+    async def __work(self, idx:int):
+        '工作协程'
+        while True:
+            if asyncio.current_task() in self.__retiring:
+                self.__retiring.discard(asyncio.current_task())
+                logger.debug(f"Worker {idx} stopped")
+                return
+            try:
+                self.__event.clear()
+                job = await self.__claim()
+                if job is None:
+                    # 不用wait_for: 事件刚好在取消时触发的话，wait_for会把取消吞掉，关闭时工作协程就停不下来
+                    waiter = asyncio.ensure_future(self.__event.wait())
+                    try:
+                        await asyncio.wait([waiter], timeout=config.queue['poll_interval'])
+                    finally:
+                        waiter.cancel()
+                    continue
+
+                logger.debug(f"Worker {idx} running job {job.id} ({job.kind})")
+                try:
+                    await self.__run(job)
+                finally:
+                    self.__running[job.host] -= 1
+                    # 主机空出来以后可能有别的任务能领了
+                    self.__event.set()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # 数据库暂时出错之类的，等一会儿再继续，不能让工作协程退出
+                logger.error(f"Worker {idx} error: {traceback.format_exc()}")
+                await asyncio.sleep(config.queue['poll_interval'])
+
+    async def __run(self, job:UploadJob):
+        '执行任务并记录结果'
+        attempts = job.attempts + 1
+        try:
+            is_ok = await handlers[job.kind](job.payload)
+            last_error = "" if is_ok else "Some of the files failed to upload"
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.error(f"Job {job.id} error: {traceback.format_exc()}")
+            is_ok = False
+            last_error = traceback.format_exc()
+
+        if is_ok:
+            logger.info(f"Job {job.id} completed.")
+            await UploadJob.filter(id=job.id).delete()
+        elif attempts >= config.queue['max_attempts']:
+            logger.error(f"Job {job.id} failed after {attempts} attempts.")
+            await UploadJob.filter(id=job.id).update(
+                status='failed', attempts=attempts, last_error=last_error
+                )
+        else:
+            delay = config.queue['retry_interval'] * 2**(attempts-1)
+            next_time = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(seconds=delay)
+            logger.warning(f"Job {job.id} will be retried at {next_time.isoformat()}")
+            await UploadJob.filter(id=job.id).update(
+                status='waiting', attempts=attempts, next_time=next_time, last_error=last_error
+                )
+
+
+pool = WorkerPool()
+
+async def init():
+    '初始化'
+    # 上次退出时没跑完的任务重新排队
+    await UploadJob.filter(status='running').update(status='waiting')
+    workers = config.queue['workers']
+    pool.start(workers)
+    logger.debug(f"Upload queue started (Workers: {workers})")
+    return pool
+
+enqueue_lock = asyncio.Lock()
+
+async def enqueue(kind:str, payload:dict, url:str="", key:str="", delay:float=0):
+    '''
+    添加任务，delay秒后开始
+    key: 不为空时，同类同key还没开始的任务合并成一个(保留第一个任务的内容)，开始时间推迟到delay秒后
+    '''
+    next_time = datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(seconds=delay)
+    async with enqueue_lock:
+        if key:
+            job = await UploadJob.filter(kind=kind, key=key, status='waiting', attempts=0).first()
+            if job is not None:
+                await UploadJob.filter(id=job.id).update(next_time=max(next_time, job.next_time))
+                logger.debug(f"Job {job.id} ({kind}) postponed to {next_time.isoformat()}.")
+                return job.id
+        job = await UploadJob.create(
+            kind=kind,
+            payload=payload,
+            host=network.SessionPool.get_host(url) if url else "",
+            key=key,
+            status='waiting',
+            next_time=next_time,
+            )
+    logger.debug(f"Job {job.id} ({kind}) enqueued.")
+    pool.notify()
+    return job.id
+
+async def count_jobs():
+    '按状态统计队列里的任务数量'
+    res = await UploadJob.annotate(count=Count('id')).group_by('status').values('status', 'count')
+    return {i['status']: i['count'] for i in res}
+
+async def get_failed_jobs():
+    '获取失败的任务'
+    return await UploadJob.filter(status='failed').order_by('id').values(
+        'id', 'kind', 'payload', 'attempts', 'last_error'
+        )
+
+async def retry_jobs(id:int=-1, retry_all=False):
+    '把失败的任务重新排队，返回各状态的任务数量'
+    query = UploadJob.filter(status='failed')
+    if not retry_all:
+        query = query.filter(id=id)
+    count = await query.update(
+        status='waiting', attempts=0, next_time=datetime.datetime.now(tz=datetime.timezone.utc)
+        )
+    logger.info(f"{count} failed jobs requeued.")
+    pool.notify()
+    return await count_jobs()
@@ -0,0 +1,48 @@
+import os, datetime
+
+import alist
+import blrec
+import autobackup
+import upload_queue
+from static import config
+
+
+async def upload_postprocessed(payload:dict):
+    '视频后处理完成，上传+自动备份'
+    filename = payload['path']
+
+    # 自动备份：先加上，blrec出问题导致上传失败的话也不影响备份
+    # 同一个文件夹的分段合并成一次，最后一个分段完成一段时间后再添加
+    # 备份时间按第一个分段完成的时间算，不受等待时间和上传重试影响(旧版的任务没有记录时间)
+    local_dir = os.path.split(filename)[0]
+    time_ref = payload.get('time') or datetime.datetime.now(tz=datetime.timezone.utc).isoformat()
+    await upload_queue.enqueue(
+        'autobackup', {'local_dir': local_dir, 'time': time_ref},
+        key=local_dir, delay=config.queue['coalesce_window']
+        )
+
+    # 获取直播间信息
+    room_id = payload['room_id']
+    room_info = await blrec.get_blrec_data(room_id)
+    if not room_info:
+        raise RuntimeError(f"Failed to get room info of {room_id} from blrec")
+
+    # 上传
+    return await alist.upload_video(filename, rec_info=room_info, settings_alist=config.alist)
+
+async def add_autobackup(payload:dict):
+    '添加录播文件夹的自动备份'
+    # 旧版的任务没有记录时间
+    time_ref = datetime.datetime.fromisoformat(payload['time']) if 'time' in payload else None
+    await autobackup.add_autobackup(
+        settings_autobackup = config.autobackup, 
+        local_dir = payload['local_dir'],
+        time_ref = time_ref)
+    return True
+
+
+# 任务类型 -> 处理函数
+handlers = {
+    'postprocessed': upload_postprocessed,
+    'autobackup': add_autobackup,
+}